@@ -0,0 +1,55 @@
+#!/usr/bin/env python3.6
+# -*- coding:Utf-8 -*-
+"""
+Memory used by the players and games kept by the server.
+
+Creates players in a cache, then games of GAME_SIZE of them, started, and reports the bytes allocated per player and
+per game (including their indexes in the cache). From the root of the repository :
+
+    python3 -m benchmarks.memory [players count]
+"""
+import gc
+import sys
+import tracemalloc
+
+from common import cache, objects
+
+GAME_SIZE = 10
+
+
+def measure(players_count):
+    cache_store = cache.Cache()
+    gc.collect()
+    tracemalloc.start()
+
+    start = tracemalloc.get_traced_memory()[0]
+    players = []
+    for i in range(players_count):
+        player = objects.Player(f"Player {i}")
+        cache_store.add_player(player)
+        players.append(player)
+    after_players = tracemalloc.get_traced_memory()[0]
+
+    games_count = players_count // GAME_SIZE
+    for i in range(games_count):
+        members = players[i * GAME_SIZE:(i + 1) * GAME_SIZE]
+        game = objects.Game(f"Game {i}", members[0])
+        cache_store.add_game(game)
+        for player in members:
+            game.join(player)
+        game.start()
+    after_games = tracemalloc.get_traced_memory()[0]
+
+    tracemalloc.stop()
+    return {
+        "players": players_count,
+        "games": games_count,
+        "bytes_per_player": round((after_players - start) / players_count),
+        "bytes_per_game": round((after_games - after_players) / games_count),
+    }
+
+
+if __name__ == '__main__':
+    result = measure(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
+    print(f"{result['players']} players : {result['bytes_per_player']} bytes per player")
+    print(f"{result['games']} games of {GAME_SIZE} players : {result['bytes_per_game']} bytes per game")
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3.6
+# -*- coding:Utf-8 -*-
+"""
+Benchmarks of the server, run in-process : the hug endpoints of server/launch.py are called without a network socket,
+and the engine (Game, Cache) is measured directly with 10, 1000 and 100000 players.
+
+The results are written to a JSON file, and compared to a baseline : the benchmarks slower than the baseline by more
+than the tolerance are listed, and the exit code is 1. From the root of the repository :
+
+    python3 -m benchmarks.suite                    # Run, compare to benchmarks/baseline.json
+    python3 -m benchmarks.suite --save-baseline    # Run, and make the results the new baseline
+    python3 -m benchmarks.suite --sizes 10,1000 --only engine
+
+Timings depend on the machine : the baseline should be made on the machine the benchmarks are compared on.
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import sys
+
+import time
+
+# The server must not load or save its state while benchmarked, nor log every request.
+os.environ.setdefault("WEREWOLVES_DATA_DIR", "")
+os.environ.setdefault("WEREWOLVES_LOG_LEVEL", "WARNING")
+
+from benchmarks import memory
+from common import cache, events, objects
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+RESULTS_PATH = "bench_results.json"
+SIZES = (10, 1000, 100000)
+# Time spent measuring each benchmark, in seconds
+BENCH_TIME = 0.3
+TOLERANCE = 0.25
+
+
+## HARNESS ##
+
+
+def bench(fn, setup=None, bench_time=BENCH_TIME):
+    """
+    Call fn() repeatedly for about bench_time seconds, calling setup() (not timed) before each call if given.
+
+    Returns the median time of a call, in microseconds.
+    """
+    timings = []
+    deadline = time.perf_counter() + bench_time
+    while time.perf_counter() < deadline or len(timings) < 5:
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    return round(timings[len(timings) // 2] * 1e6, 3)
+
+
+def make_game(size, cache_store=None):
+    """
+    A started game of `size` players. Players are added directly, as joining one by one is quadratic in the game size.
+    """
+    players = [objects.Player(f"Player {i}") for i in range(size)]
+    game = objects.Game("Benchmark", players[0])
+    if cache_store:
+        for player in players:
+            cache_store.add_player(player)
+        cache_store.add_game(game)
+
+    for player in players:
+        game.players.add(player)
+        player.games.add(game)
+    game.start()
+    game.phase = game.STATE_NIGHT_WEREWOLVES
+    game.need_to_complete_phase_before = int(time.time()) + objects.HOUR
+    return game, players
+
+
+## ENGINE ##
+
+
+def engine_benchmarks(size):
+    results = {}
+    cache_store = cache.Cache()
+    game, players = make_game(size, cache_store)
+    alive = list(game.alive_by_uuid)
+
+    results["tick_idle"] = bench(game.tick)
+    results["should_tick"] = bench(game.should_tick)
+    results["public_dict"] = bench(game.public_dict)
+
+    voters = players[:min(size, 1000)]
+
+    def fill_votes():
+        # Votes without touching the game, to only measure the resolution
+        for i, player in enumerate(voters):
+            game.votes[player] = {alive[i % len(alive)]}
+            game._tally_vote(player)
+
+    results["get_votes"] = bench(game.get_votes, setup=fill_votes)
+    game.clear_votes()
+
+    voter = iter(range(10 ** 9))
+    results["vote"] = bench(lambda: game.vote(players[next(voter) % size], {alive[0]}))
+
+    player = players[size // 2]
+    results["cache_get_player_by_uuid"] = bench(lambda: cache_store.get_player_by_uuid(player.uuid))
+    results["cache_get_user_from_auth"] = bench(lambda: cache_store.get_user_from_auth(player.uuid, player.token))
+    results["cache_touch_player"] = bench(lambda: cache_store.touch_player(player))
+
+    for i in range(min(size, 1000)):
+        cache_store.add_game(objects.Game(f"Game {i}", players[i]))
+    results["cache_list_games"] = bench(lambda: cache_store.list_games([0], limit=50))
+
+    # Replay of a game with the players joining, then rounds of votes, per event
+    now = int(time.time())
+    game_events = [("created", now, "Benchmark", players[0].uuid, players[0].name, now)]
+    game_events += [("joined", now, p.uuid, p.name) for p in players]
+    game_events.append(("started", now, now, [(c.owner.uuid, c.name) for c in game.cards]))
+    for _ in range(10):
+        game_events += [("voted", now, p.uuid, [alive[0]]) for p in voters]
+        game_events.append(("votes_cleared", now))
+    results["replay_event"] = round(bench(lambda: events.replay(game.uuid, game_events)) / len(game_events), 3)
+
+    return {f"engine.{name}[{size}]": value for name, value in results.items()}
+
+
+## ENDPOINTS ##
+
+
+def endpoint_benchmarks():
+    import hug
+    from falcon.testing import create_environ
+    from hug.test import StartResponseMock, _internal_result
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server"))
+    import launch
+
+    # Ticks are made by the benchmark, not in the background
+    launch.phase_scheduler.close()
+
+    # Like hug.test.call(), that builds the WSGI application on each call
+    server = hug.API(launch).http.server()
+
+    def call(endpoint, body, headers=None):
+        headers = dict(headers or {}, **{"content-type": "application/json"})
+        response = StartResponseMock()
+        result = server(create_environ(path=f"/v1/{endpoint}", method="POST", headers=headers,
+                                       body=hug.output_format.json(body)), response)
+        data = json.loads(_internal_result(result))
+        if not response.status.startswith("200"):
+            raise Exception(f"{endpoint} returned {response.status} : {data}")
+        return data
+
+    def login(name="Benchmark"):
+        res = call("login", {"name": name})
+        auth = base64.b64encode(f"{res['uuid']}:{res['token']}".encode()).decode()
+        return res["uuid"], {"Authorization": f"Basic {auth}"}
+
+    results = {}
+    results["login"] = bench(login)
+
+    players = [login(f"Player {i}") for i in range(8)]
+    owner = players[0][1]
+    results["create_game"] = bench(lambda: call("create_game", {"name": "Benchmark"}, owner))
+
+    def new_game():
+        return call("create_game", {"name": "Benchmark"}, owner)
+
+    games = iter([])
+
+    def setup_join():
+        nonlocal games
+        games = iter([new_game()])
+
+    results["join_game"] = bench(lambda: call("join_game", {"uuid": next(games)}, players[1][1]), setup=setup_join)
+
+    game_uuid = new_game()
+    for _, headers in players[1:]:
+        call("join_game", {"uuid": game_uuid}, headers)
+    call("start_game", {"uuid": game_uuid}, owner)
+    game = launch.cache_store.get_game_by_uuid(game_uuid)
+
+    results["game_status"] = bench(lambda: call("game_status", {"uuid": game_uuid}, owner))
+    results["game_status_delta"] = bench(lambda: call("game_status", {"uuid": game_uuid, "since": game.revision - 1,
+                                                                      "expand": "players"}, owner))
+    results["player_status"] = bench(lambda: call("player_status", {"uuid": players[1][0]}, owner))
+    target = players[1][0]
+    results["select_player"] = bench(lambda: call("select_player", {"game_uuid": game_uuid, "players_uuid": target},
+                                                  owner))
+
+    def full_game():
+        game_uuid = new_game()
+        for _, headers in players[1:]:
+            call("join_game", {"uuid": game_uuid}, headers)
+        call("start_game", {"uuid": game_uuid}, owner)
+        game = launch.cache_store.get_game_by_uuid(game_uuid)
+
+        while game.phase != game.STATE_FINISHED:
+            alive = list(game.alive_by_uuid)
+            uuids = ",".join(alive[:2]) if game.phase == game.STATE_NIGHT_CUPID else alive[0]
+            for uuid, headers in players:
+                call("select_player", {"game_uuid": game_uuid, "players_uuid": uuids}, headers)
+            with launch.cache_store.transaction():
+                game.tick(force=True)
+
+    results["full_game"] = bench(full_game)
+
+    return {f"endpoint.{name}": value for name, value in results.items()}
+
+
+## MEMORY ##
+
+
+def memory_benchmarks(size):
+    result = memory.measure(size)
+    return {
+        f"memory.bytes_per_player[{size}]": result["bytes_per_player"],
+        f"memory.bytes_per_game[{size}]": result["bytes_per_game"],
+    }
+
+
+## COMPARISON ##
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Returns the benchmarks (name, baseline, result) slower or bigger than the baseline by more than `tolerance`.
+    """
+    regressions = []
+    for name, value in sorted(results.items()):
+        base = baseline.get(name)
+        if base and value > base * (1 + tolerance):
+            regressions.append((name, base, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Werewolves server benchmarks")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in SIZES),
+                        help="Comma separated numbers of players for the engine benchmarks")
+    parser.add_argument("--only", choices=("engine", "endpoint", "memory"), help="Only run one kind of benchmarks")
+    parser.add_argument("--output", default=RESULTS_PATH, help="Where the results are written")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline to compare the results to")
+    parser.add_argument("--save-baseline", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="Allowed slowdown, 0.25 for 25%%")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    results = {}
+    if args.only in (None, "engine"):
+        for size in sizes:
+            results.update(engine_benchmarks(size))
+    if args.only in (None, "memory"):
+        results.update(memory_benchmarks(min(max(sizes), 10000)))
+    if args.only in (None, "endpoint"):
+        results.update(endpoint_benchmarks())
+
+    for name, value in sorted(results.items()):
+        unit = "bytes" if name.startswith("memory.") else "µs"
+        print(f"{name:50} {value:>14} {unit}")
+
+    report = {"python": platform.python_version(), "machine": platform.machine(), "time": int(time.time()),
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, nothing to compare to.")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+
+    regressions = compare(results, baseline, args.tolerance)
+    for name, base, value in regressions:
+        print(f"REGRESSION {name} : {base} -> {value} ({round((value / base - 1) * 100)}% worse)")
+    if not regressions:
+        print(f"No regression compared to {args.baseline}.")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
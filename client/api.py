@@ -1,11 +1,41 @@
+import random
 import time
+import weakref
+from collections import OrderedDict
 API_URL = "http://werewolves.api-d.com:8000/"
 API_VERSION = "v1"
 COMPLETE_API_URL = API_URL + API_VERSION + "/"
+BULK_MAX = 500
 AUTH = None
 
+# Secondes pour se connecter, et pour recevoir la réponse (en plus de l'attente demandée pour un long-poll)
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+# Connexions gardées ouvertes vers le serveur
+POOL_SIZE = 4
+# Nouveaux essais après une erreur passagère, espacés d'un délai aléatoire qui double à chaque fois
+RETRIES = 4
+BACKOFF_BASE = 0.2
+BACKOFF_MAX = 5
+RETRY_STATUSES = (429, 502, 503, 504)
+# Ces appels ne sont pas refaits si le serveur a pu les recevoir : ils ne doivent pas être faits deux fois
+NOT_IDEMPOTENT = ("login", "create_game", "sorceress_select")
+# Échecs de suite avant d'arrêter d'appeler le serveur, et pendant combien de secondes
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+# Joueurs et parties gardés en cache (chacun), les plus récemment utilisés
+IDENTITY_MAP_SIZE = 1000
+# Réponses avec un ETag gardées pour être réutilisées après un 304, les plus récemment utilisées. Les appels avec
+# `since` ou `revision` font une entrée par révision : sans limite, le cache grandirait pendant toute la partie.
+RESPONSES_CACHE_SIZE = 1000
+# Secondes après lesquelles un objet du cache est redemandé au serveur, même sans changement connu. C'est peu coûteux :
+# seules les modifications d'une partie sont demandées, et un joueur qui n'a pas changé est une réponse 304.
+CACHE_MAX_AGE = 10
+
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 
 
 import logging
@@ -127,9 +157,163 @@ else:
     ColorStreamHandler = _AnsiColorStreamHandler
 
 
+class ServerUnavailable(Exception):
+    """
+    Le serveur a échoué trop de fois de suite : les appels sont coupés pendant `retry_after` secondes.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Server unavailable, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Coupe les appels au serveur après `threshold` échecs de suite, pendant `reset_timeout` secondes, pour ne pas
+    l'accabler quand il est en difficulté. Ensuite, un appel d'essai est permis : s'il réussit, les appels reprennent,
+    sinon ils sont coupés à nouveau.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def check(self):
+        """
+        Lève ServerUnavailable si les appels sont coupés.
+        """
+        if self.opened_at is None:
+            return
+
+        wait = self.opened_at + self.reset_timeout - time.time()
+        if wait > 0 or self.trial:
+            raise ServerUnavailable(max(wait, 1))
+        self.trial = True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        if self.trial or self.failures >= self.threshold:
+            self.opened_at = time.time()
+            self.trial = False
+
+
+def backoff(attempt):
+    """
+    Délai avant le nouvel essai numéro `attempt` (0 pour le premier) : aléatoire, jusqu'à un maximum qui double à
+    chaque essai, pour que les clients ne réessaient pas tous en même temps.
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def not_sent(error):
+    """
+    True si l'erreur `error` de requests est survenue en se connectant (connexion refusée, trop longue) : le serveur n'a
+    pas reçu la requête, elle peut être refaite sans risque.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    # requests enveloppe l'erreur de urllib3 dans un MaxRetryError
+    reason = getattr(reason, "reason", reason)
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+class IdentityMap:
+    """
+    Un seul objet (Player, Game) par uuid : les réponses du serveur mettent à jour l'objet existant sur place, au lieu
+    d'en créer un nouveau. Les `size` objets utilisés le plus récemment sont gardés, les autres restent connus tant
+    qu'ils sont utilisés ailleurs.
+
+    Un objet est à jour (fresh) tant qu'on n'a pas appris qu'il a changé (une révision plus récente vue dans une
+    réponse, ou une action de ce client dessus), et pendant au plus `max_age` secondes : les changements faits par les
+    autres joueurs ou par le serveur ne sont pas annoncés. Sinon, il faut le redemander au serveur.
+    """
+
+    def __init__(self, size=IDENTITY_MAP_SIZE, max_age=CACHE_MAX_AGE):
+        self.size = size
+        self.max_age = max_age
+        # uuid -> objet, le moins récemment utilisé en premier
+        self.recent = OrderedDict()
+        self.known = weakref.WeakValueDictionary()
+
+    def get(self, uuid):
+        obj = self.recent.get(uuid)
+        if obj is None:
+            obj = self.known.get(uuid)
+            if obj is None:
+                return None
+            self.recent[uuid] = obj
+            self._evict()
+        self.recent.move_to_end(uuid)
+        return obj
+
+    def fresh(self, uuid):
+        """
+        L'objet, s'il est connu et à jour, sinon None.
+        """
+        obj = self.get(uuid)
+        return obj if obj is not None and self.is_fresh(obj) else None
+
+    def is_fresh(self, obj):
+        return obj.fresh and time.time() - obj.data["last_update"] < self.max_age
+
+    def store(self, uuid, data, factory):
+        """
+        Met à jour l'objet `uuid` avec `data`, une réponse du serveur, ou le crée avec factory(data) s'il n'est pas
+        connu. Une réponse plus ancienne que l'objet (révision plus petite) est ignorée.
+        """
+        obj = self.get(uuid)
+        if obj is None:
+            obj = factory(data)
+            self.recent[uuid] = obj
+            self.known[uuid] = obj
+            self._evict()
+        elif data.get("revision", 0) >= obj.data.get("revision", 0):
+            obj.update(data)
+        else:
+            return obj
+
+        obj.fresh = True
+        return obj
+
+    def seen(self, uuid, revision):
+        """
+        L'objet `uuid` est à la révision `revision` sur le serveur.
+        """
+        obj = self.known.get(uuid)
+        if obj is not None and revision > obj.data.get("revision", 0):
+            obj.fresh = False
+
+    def invalidate(self, uuid):
+        obj = self.known.get(uuid)
+        if obj is not None:
+            obj.fresh = False
+
+    def _evict(self):
+        while len(self.recent) > self.size:
+            self.recent.popitem(last=False)
+
+
 class Api:
     def __init__(self, name):
         self.authed = False
+        # (path, data) -> last response with an ETag, reused when the server answers 304 Not Modified.
+        # Least recently used first, at most RESPONSES_CACHE_SIZE.
+        self.responses_cache = OrderedDict()
+
+        # Connexions HTTP gardées ouvertes (keep-alive) et réutilisées d'un appel à l'autre
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+        self.breaker = CircuitBreaker()
 
         logger = logging.getLogger("werewolves")
         logger.setLevel(logging.DEBUG)
@@ -148,9 +332,10 @@ class Api:
         login_resp = self.call_api("login", {"name" : name}).json()
         self.uuid = login_resp["uuid"]
         self.token = login_resp["token"]
+        self.session.auth = HTTPBasicAuth(self.uuid, self.token)
         self.authed = True
-        self.players_cache = {}
-        self.games_cache = {}
+        self.players_cache = IdentityMap()
+        self.games_cache = IdentityMap()
         self.me = self.get_player(self.uuid, force_update=True)
 
 
@@ -161,60 +346,181 @@ class Api:
         Exemple :
             call_api("login", {"name":name})
 
+        Si une réponse précédente à la même requête avait un ETag, il est renvoyé au serveur, et la réponse en cache
+        est réutilisée si le serveur répond 304 Not Modified.
+
+        Les erreurs passagères (connexion, délai dépassé, serveur surchargé) sont réessayées RETRIES fois. Après trop
+        d'échecs de suite, ServerUnavailable est levée sans appeler le serveur.
         """
         url = COMPLETE_API_URL + path
-        self.logger.debug(f"-> {url} || {data}")
+        self.logger.debug("-> %s || %s", url, data)
+
+        cache_key = (path, tuple(sorted(data.items())))
+        cached = self.responses_cache.get(cache_key)
+        headers = {"If-None-Match": cached.headers["ETag"]} if cached is not None else {}
+        # Un long-poll peut attendre `wait` secondes avant de répondre
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT + float(data.get("wait", 0)))
 
         time_start = time.time()
+        res = self.post(path, url, data, headers, timeout)
+        time_stop = time.time()
 
-        if self.authed:
-            res = requests.post(url, data, auth=HTTPBasicAuth(self.uuid, self.token))
-        else:
-            res = requests.post(url, data)
+        if res.status_code == 304 and cached is not None:
+            self.logger.debug("<- %s || (304) Not modified, using cached response", url)
+            self.responses_cache.move_to_end(cache_key)
+            return cached
+
+        if "ETag" in res.headers:
+            self.responses_cache[cache_key] = res
+            self.responses_cache.move_to_end(cache_key)
+            if len(self.responses_cache) > RESPONSES_CACHE_SIZE:
+                self.responses_cache.popitem(last=False)
 
-        time_stop = time.time()
         js = res.json()
-        self.logger.debug(f"<- {url} || ({res.status_code}) {js}")
+        self.logger.debug("<- %s || (%s) %s", url, res.status_code, js)
         total_time = time_stop-time_start
 
-        self.logger.debug(f"Took {total_time} to get res from API")
+        self.logger.debug("Took %s to get res from API", total_time)
 
         if type(js) == dict and "errors" in js.keys():
             raise Exception(str(js["errors"]))
 
         return res
 
+    def post(self, path, url, data, headers, timeout):
+        """
+        Envoie la requête, en réessayant après les erreurs passagères. Un appel qui échoue malgré ses essais compte pour
+        un seul échec du CircuitBreaker.
+        """
+        self.breaker.check()
+        for attempt in range(RETRIES + 1):
+            try:
+                res = self.session.post(url, data=data, headers=headers, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # Sans réponse, on ne sait pas si le serveur a reçu l'appel, sauf s'il n'a pas pu se connecter
+                retry = path not in NOT_IDEMPOTENT or not_sent(e)
+                error = e
+            else:
+                if res.status_code not in RETRY_STATUSES:
+                    self.breaker.success()
+                    return res
+                retry = path not in NOT_IDEMPOTENT
+                error = None
+
+            if not retry or attempt == RETRIES:
+                self.breaker.failure()
+                if error:
+                    raise error
+                return res
+
+            delay = backoff(attempt)
+            self.logger.warning("%s failed (%s), retrying in %.2fs", url, error or res.status_code, delay)
+            time.sleep(delay)
+
     def get_player(self, uuid, force_update = False):
-        if force_update or uuid not in self.players_cache.keys() or (uuid in self.players_cache.keys() and self.players_cache[uuid].last_update + 120 < time.time()):
-            pl = self.call_api("player_status", {"uuid": uuid}).json()
-            player = Player(pl, api=self)
-            self.players_cache[uuid] = player
+        """
+        Le joueur, depuis le cache s'il est à jour. Toujours le même objet pour un même joueur.
+        """
+        player = self.players_cache.fresh(uuid)
+        if player is not None and not force_update:
             return player
-        else:
-            return self.players_cache[uuid]
+
+        pl = self.call_api("player_status", {"uuid": uuid}).json()
+        return self.players_cache.store(uuid, pl, lambda data: Player(data, api=self))
+
+    def get_players(self, uuids):
+        """
+        Get many players at once. Players that aren't in the cache are fetched with as few calls as possible.
+
+        Returns a dict of players, indexed by uuid.
+        """
+        players = {}
+        missing = []
+        for uuid in uuids:
+            player = self.players_cache.fresh(uuid)
+            if player is not None:
+                players[uuid] = player
+            elif uuid not in missing:
+                missing.append(uuid)
+
+        for i in range(0, len(missing), BULK_MAX):
+            profiles = self.call_api("players_status", {"uuids": ",".join(missing[i:i + BULK_MAX])}).json()
+            players.update(self.cache_players(profiles))
+
+        return players
+
+    def cache_players(self, profiles):
+        """
+        Store public player profiles (as returned by players_status, or inlined by game_status) in the cache.
+        """
+        players = {}
+        for uuid, profile in profiles.items():
+            players[uuid] = self.players_cache.store(uuid, profile, lambda data: Player(data, api=self))
+        return players
 
     def get_game(self, uuid, force_update = False):
-        if force_update or uuid not in self.games_cache.keys() or (uuid in self.games_cache.keys() and self.games_cache[uuid].last_update + 120 < time.time()):
-            gm = self.call_api("game_status", {"uuid": uuid}).json()
-            game = Game(gm, api=self)
-            self.players_cache[uuid] = game
+        """
+        La partie, depuis le cache si elle est à jour. Si elle a changé, seules les modifications sont demandées.
+        Toujours le même objet pour une même partie.
+        """
+        game = self.games_cache.get(uuid)
+        if game is not None and not force_update:
+            if not self.games_cache.is_fresh(game) and "revision" in game.data:
+                self.update_game(game)
             return game
+
+        gm = self.call_api("game_status", {"uuid": uuid, "expand": "players"}).json()
+        self.cache_players(gm.pop("players_profiles", {}))
+        return self.games_cache.store(uuid, gm, lambda data: Game(data, api=self))
+
+    def update_game(self, game, wait=0):
+        """
+        Update a game in place, asking the server only for what changed since the revision we have.
+        If `wait` is given, long-poll the server : returns as soon as the game changed, or after `wait` seconds with
+        the same state.
+        """
+        data = {"uuid": game.uuid, "since": game.data["revision"], "expand": "players"}
+        if wait:
+            data["revision"] = game.data["revision"]
+            data["wait"] = wait
+
+        gm = self.call_api("game_status", data).json()
+        self.cache_players(gm.pop("players_profiles", {}))
+        if gm.get("delta"):
+            game.apply_delta(gm)
         else:
-            return self.games_cache[uuid]
+            game.update(gm)
+        game.fresh = True
+
+        return game
+
+    def wait_game(self, game, timeout=20):
+        return self.update_game(game, wait=timeout)
+
+    def changed(self, game):
+        """
+        Après une action de ce client, la partie et notre profil ne sont plus à jour.
+        """
+        self.games_cache.invalidate(game.uuid)
+        self.players_cache.invalidate(self.uuid)
 
     def create_game(self, name):
         resp = self.call_api("create_game", {"name": name}).json()
+        self.players_cache.invalidate(self.uuid)
         return self.get_game(resp)
 
     def join_game(self, game):
         self.call_api("join_game", {"uuid": game.uuid}).json()
+        self.changed(game)
         return self.get_game(game.uuid)
 
     def leave_game(self, game):
         self.call_api("leave_game", {"uuid": game.uuid})
+        self.changed(game)
 
     def start_game(self, game):
         self.call_api("start_game", {"uuid": game.uuid})
+        self.changed(game)
 
     def select_player(self, game, players:list):
         csp = ""
@@ -223,6 +529,7 @@ class Api:
 
         csp = csp[:-1]
         self.call_api("select_player", {"game_uuid": game.uuid, "players_uuid": csp})
+        self.changed(game)
 
     def sorceress_select(self, game, player, save):
         if save:
@@ -231,27 +538,57 @@ class Api:
             save_or_kill = None
 
         self.call_api("sorceress_select", {"game_uuid": game.uuid, "player_uuid": player.uuid, "save_or_kill": save_or_kill})
+        self.changed(game)
 
-    def list_games(self):
-        games_uuid = self.call_api("list_games", {}).json()
-        games = []
-        for game in games_uuid:
-            games.append(self.get_game(game))
-        return games
+    def list_games(self, phase=None, prefix=None, cursor=None):
+        """
+        Une page des parties du serveur, les plus récentes en premier, sous forme de GameSummary.
+
+        phase : ne garder que les parties dans cette phase (0 pour celles que l'on peut rejoindre)
+        prefix : ne garder que les parties dont le nom commence par ce texte
+        cursor : le curseur renvoyé avec la page précédente
+
+        Renvoie (parties, curseur de la page suivante ou None)
+        """
+        data = {}
+        if phase is not None:
+            data["phase"] = str(phase)
+        if prefix:
+            data["prefix"] = prefix
+        if cursor:
+            data["cursor"] = cursor
+
+        page = self.call_api("list_games", data).json()
+        for row in page["games"]:
+            self.games_cache.seen(row["uuid"], row.get("revision", 0))
+        return [GameSummary(row, api=self) for row in page["games"]], page["cursor"]
 
 
 class Player:
+    # Pas de changement connu depuis la dernière réponse du serveur (voir IdentityMap)
+    fresh = True
+
     def __init__(self, player_dict, api):
         self.data = player_dict
         self.data["api"] = api
         self.data["last_update"] = time.time()
 
     def __getattr__(self, item):
-
-        if item == "games" or "games_created":
+        if item in ("games", "games_created"):
             self.load_games()
 
-        return self.data[item]
+        try:
+            return self.data[item]
+        except KeyError:
+            raise AttributeError(item)
+
+    def update(self, player_dict):
+        """
+        Met le joueur à jour sur place. Les champs absents de `player_dict` sont gardés : un profil public ne
+        contient pas les cartes de notre profil privé.
+        """
+        self.data.update(player_dict)
+        self.data["last_update"] = time.time()
 
     def load_games(self):
         ng = []
@@ -273,17 +610,70 @@ class Player:
         self.data["games_created"] = ng
 
 
+class GameSummary:
+    """
+    Une ligne de list_games : uuid, name, phase, player_count, owner, owner_name et created_at.
+    La partie complète s'obtient avec get_game().
+    """
+
+    def __init__(self, summary_dict, api):
+        self.data = summary_dict
+        self.data["api"] = api
+
+    def __getattr__(self, item):
+        return self.data[item]
+
+    def get_game(self):
+        return self.api.get_game(self.uuid)
+
+
 class Game:
+    # Pas de changement connu depuis la dernière réponse du serveur (voir IdentityMap)
+    fresh = True
+
     def __init__(self, game_dict, api):
+        api.cache_players(game_dict.pop("players_profiles", {}))
         self.data = game_dict
         self.data["api"] = api
         self.data["last_update"] = time.time()
 
     def __getattr__(self, item):
-        if item == "players" or "players_killed_last_night" or "players_alive" or "owner" or "mayor":
+        if item in ("players", "players_killed_last_night", "players_alive", "owner", "mayor"):
             self.load_players()
 
-        return self.data[item]
+        try:
+            return self.data[item]
+        except KeyError:
+            raise AttributeError(item)
+
+    def update(self, game_dict):
+        api = self.data["api"]
+        self.data = game_dict
+        self.data["api"] = api
+        self.data["last_update"] = time.time()
+
+    def apply_delta(self, delta):
+        """
+        Apply a delta returned by game_status (called with `since`) to our copy of the game.
+        Lists may already contain Player objects, so members are compared by uuid.
+        """
+        if delta["base_revision"] != self.data["revision"]:
+            raise Exception(f"Delta from revision {delta['base_revision']} can't be applied on {self.data['revision']}")
+
+        def uuid_of(player):
+            return player.data["uuid"] if isinstance(player, Player) else player
+
+        for key, removed in delta["removed"].items():
+            removed = set(removed)
+            self.data[key] = [p for p in self.data[key] if uuid_of(p) not in removed]
+
+        for key, added in delta["added"].items():
+            self.data[key] = self.data[key] + added
+
+        self.data.update(delta["set"])
+        self.data["time_left"] = delta["time_left"]
+        self.data["revision"] = delta["revision"]
+        self.data["last_update"] = time.time()
 
     def start(self):
         self.api.start_game(self)
@@ -298,39 +688,21 @@ class Game:
         return self.owner.uuid == self.api.uuid
 
     def load_players(self):
-        np = []
-        for player in self.data["players"][:]:
-            if not isinstance(player, Player):
-                np.append(self.data["api"].get_player(player, force_update=False))
-            else:
-                np.append(player)
-
-        self.data["players"] = np
-
-        np = []
-        for player in self.data["players_killed_last_night"][:]:
-            if not isinstance(player, Player):
-                np.append(self.data["api"].get_player(player))
-            else:
-                np.append(player)
-
-        self.data["players_killed_last_night"] = np
-
-        np = []
-        for player in self.data["players_alive"][:]:
-            if not isinstance(player, Player):
-                np.append(self.data["api"].get_player(player))
-            else:
-                np.append(player)
-
-        self.data["players_alive"] = np
-
-        if not isinstance(self.data["owner"], Player):
-            self.data["owner"] = self.data["api"].get_player(self.data["owner"])
-
-        if self.data["mayor"] and not isinstance(self.data["mayor"], Player):
-            self.data["mayor"] = self.data["api"].get_player(self.data["mayor"])
+        rosters = ("players", "players_killed_last_night", "players_alive")
+        uuids = [p for key in rosters for p in self.data[key] if not isinstance(p, Player)]
+        for key in ("owner", "mayor"):
+            if self.data[key] and not isinstance(self.data[key], Player):
+                uuids.append(self.data[key])
 
+        if not uuids:
+            return
 
+        # One call for the whole roster, instead of one per player
+        players = self.data["api"].get_players(uuids)
 
+        for key in rosters:
+            self.data[key] = [players.get(p, p) if not isinstance(p, Player) else p for p in self.data[key]]
 
+        for key in ("owner", "mayor"):
+            if self.data[key] and not isinstance(self.data[key], Player):
+                self.data[key] = players.get(self.data[key], self.data[key])
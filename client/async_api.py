@@ -0,0 +1,358 @@
+"""
+Version asyncio de l'Api, pour faire jouer beaucoup de joueurs depuis un seul processus (bots, supervision).
+
+Les joueurs partagent un AsyncPool : une seule session HTTP, dont le nombre de connexions est borné, et un seul
+CircuitBreaker pour le serveur. Exemple :
+
+    async with AsyncPool(max_connections=50) as pool:
+        apis = await asyncio.gather(*(AsyncApi.login(f"Bot {i}", pool) for i in range(200)))
+        game = await apis[0].create_game("Partie des bots")
+        await asyncio.gather(*(api.join_game(game) for api in apis[1:]))
+        await game.start()
+
+Contrairement à Api, les joueurs et les parties liés à une partie ou un joueur ne sont pas chargés quand on y accède :
+il faut appeler `await game.load_players()` ou `await player.load_games()`.
+
+Nécessite aiohttp : `pip3 install aiohttp`.
+"""
+import asyncio
+import copy
+import json
+import logging
+
+import time
+
+from collections import OrderedDict
+
+import aiohttp
+
+from api import (COMPLETE_API_URL, BULK_MAX, CONNECT_TIMEOUT, READ_TIMEOUT, RETRIES, RETRY_STATUSES, NOT_IDEMPOTENT,
+                 RESPONSES_CACHE_SIZE, CircuitBreaker, Game, GameSummary, IdentityMap, Player, backoff)
+
+# Requêtes en cours au maximum, tous joueurs confondus. Les autres attendent une connexion libre.
+MAX_CONNECTIONS = 100
+
+logger = logging.getLogger("werewolves")
+
+
+class AsyncPool:
+    """
+    Session HTTP partagée par les AsyncApi : connexions gardées ouvertes, au plus `max_connections` à la fois.
+    Un long-poll (wait_game) occupe une connexion pendant toute son attente.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, url=None):
+        self.url = url or COMPLETE_API_URL
+        self.max_connections = max_connections
+        self.breaker = CircuitBreaker()
+        self.session = None
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        self.session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        await self.session.close()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def post(self, path, data, auth=None, headers=None):
+        """
+        Appelle l'api, en réessayant après les erreurs passagères comme Api.post().
+
+        Renvoie (code HTTP, en-têtes, réponse décodée ou None).
+        """
+        url = self.url + path
+        timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT,
+                                        sock_read=READ_TIMEOUT + float(data.get("wait", 0)))
+
+        self.breaker.check()
+        for attempt in range(RETRIES + 1):
+            try:
+                async with self.session.post(url, data=data, auth=auth, headers=headers, timeout=timeout) as res:
+                    body = await res.read()
+                    status, res_headers = res.status, res.headers
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                # Sans réponse, on ne sait pas si le serveur a reçu l'appel, sauf s'il n'a pas pu se connecter
+                retry = path not in NOT_IDEMPOTENT or isinstance(e, aiohttp.ClientConnectorError)
+                error = e
+            else:
+                if status not in RETRY_STATUSES:
+                    self.breaker.success()
+                    return status, res_headers, _decode(body)
+                retry = path not in NOT_IDEMPOTENT
+                error = None
+
+            if not retry or attempt == RETRIES:
+                # Un seul échec pour le CircuitBreaker, quel que soit le nombre d'essais
+                self.breaker.failure()
+                if error:
+                    raise error
+                return status, res_headers, _decode(body)
+
+            delay = backoff(attempt)
+            logger.warning("%s failed (%s), retrying in %.2fs", url, error or status, delay)
+            await asyncio.sleep(delay)
+
+
+def _decode(body):
+    return json.loads(body) if body else None
+
+
+class AsyncApi:
+    """
+    Un joueur connecté au serveur. Mêmes méthodes que Api, à appeler avec await.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.authed = False
+        self.auth = None
+        self.uuid = None
+        self.token = None
+        # (path, data) -> (ETag, réponse), réutilisée si le serveur répond 304 Not Modified. La moins récemment
+        # utilisée en premier, au plus RESPONSES_CACHE_SIZE.
+        self.responses_cache = OrderedDict()
+        self.players_cache = IdentityMap()
+        self.games_cache = IdentityMap()
+        self.me = None
+        self.logger = logger
+
+    @classmethod
+    async def login(cls, name, pool):
+        api = cls(pool)
+        login_resp = await api.call_api("login", {"name": name})
+        api.uuid = login_resp["uuid"]
+        api.token = login_resp["token"]
+        api.auth = aiohttp.BasicAuth(api.uuid, api.token)
+        api.authed = True
+        api.me = await api.get_player(api.uuid, force_update=True)
+        return api
+
+    async def call_api(self, path, data):
+        """
+        Appelle l'api comme définie, et renvoie la réponse décodée.
+
+        Exemple :
+            await call_api("login", {"name": name})
+        """
+        self.logger.debug("-> %s || %s", path, data)
+
+        cache_key = (path, tuple(sorted(data.items())))
+        cached = self.responses_cache.get(cache_key)
+        headers = {"If-None-Match": cached[0]} if cached is not None else {}
+
+        time_start = time.time()
+        status, res_headers, js = await self.pool.post(path, data, auth=self.auth, headers=headers)
+        total_time = time.time() - time_start
+
+        # Les réponses sont modifiées sur place par les AsyncGame et AsyncPlayer : le cache garde sa propre copie, et
+        # en donne une nouvelle à chaque fois.
+        if status == 304 and cached is not None:
+            self.logger.debug("<- %s || (304) Not modified, using cached response", path)
+            self.responses_cache.move_to_end(cache_key)
+            return copy.deepcopy(cached[1])
+
+        if "ETag" in res_headers:
+            self.responses_cache[cache_key] = (res_headers["ETag"], copy.deepcopy(js))
+            self.responses_cache.move_to_end(cache_key)
+            if len(self.responses_cache) > RESPONSES_CACHE_SIZE:
+                self.responses_cache.popitem(last=False)
+
+        self.logger.debug("<- %s || (%s) %s", path, status, js)
+        self.logger.debug("Took %s to get res from API", total_time)
+
+        if type(js) == dict and "errors" in js.keys():
+            raise Exception(str(js["errors"]))
+
+        return js
+
+    async def get_player(self, uuid, force_update=False):
+        player = self.players_cache.fresh(uuid)
+        if player is not None and not force_update:
+            return player
+
+        pl = await self.call_api("player_status", {"uuid": uuid})
+        return self.players_cache.store(uuid, pl, lambda data: AsyncPlayer(data, api=self))
+
+    async def get_players(self, uuids):
+        """
+        Plusieurs joueurs à la fois, comme Api.get_players. Les pages de BULK_MAX joueurs sont demandées en parallèle.
+
+        Renvoie un dict des joueurs, par uuid.
+        """
+        players = {}
+        missing = []
+        for uuid in uuids:
+            player = self.players_cache.fresh(uuid)
+            if player is not None:
+                players[uuid] = player
+            elif uuid not in missing:
+                missing.append(uuid)
+
+        pages = await asyncio.gather(*(self.call_api("players_status", {"uuids": ",".join(missing[i:i + BULK_MAX])})
+                                       for i in range(0, len(missing), BULK_MAX)))
+        for profiles in pages:
+            players.update(self.cache_players(profiles))
+
+        return players
+
+    def cache_players(self, profiles):
+        players = {}
+        for uuid, profile in profiles.items():
+            players[uuid] = self.players_cache.store(uuid, profile, lambda data: AsyncPlayer(data, api=self))
+        return players
+
+    async def get_game(self, uuid, force_update=False):
+        game = self.games_cache.get(uuid)
+        if game is not None and not force_update:
+            if not self.games_cache.is_fresh(game) and "revision" in game.data:
+                await self.update_game(game)
+            return game
+
+        gm = await self.call_api("game_status", {"uuid": uuid, "expand": "players"})
+        self.cache_players(gm.pop("players_profiles", {}))
+        return self.games_cache.store(uuid, gm, lambda data: AsyncGame(data, api=self))
+
+    async def update_game(self, game, wait=0):
+        """
+        Met la partie à jour, comme Api.update_game.
+        """
+        data = {"uuid": game.uuid, "since": game.data["revision"], "expand": "players"}
+        if wait:
+            data["revision"] = game.data["revision"]
+            data["wait"] = wait
+
+        gm = await self.call_api("game_status", data)
+        self.cache_players(gm.pop("players_profiles", {}))
+        if gm.get("delta"):
+            game.apply_delta(gm)
+        else:
+            game.update(gm)
+        game.fresh = True
+
+        return game
+
+    async def wait_game(self, game, timeout=20):
+        return await self.update_game(game, wait=timeout)
+
+    def changed(self, game):
+        self.games_cache.invalidate(game.uuid)
+        self.players_cache.invalidate(self.uuid)
+
+    async def create_game(self, name):
+        resp = await self.call_api("create_game", {"name": name})
+        self.players_cache.invalidate(self.uuid)
+        return await self.get_game(resp)
+
+    async def join_game(self, game):
+        await self.call_api("join_game", {"uuid": game.uuid})
+        self.changed(game)
+        return await self.get_game(game.uuid)
+
+    async def leave_game(self, game):
+        await self.call_api("leave_game", {"uuid": game.uuid})
+        self.changed(game)
+
+    async def start_game(self, game):
+        await self.call_api("start_game", {"uuid": game.uuid})
+        self.changed(game)
+
+    async def select_player(self, game, players: list):
+        await self.call_api("select_player", {"game_uuid": game.uuid,
+                                              "players_uuid": ",".join(p.uuid for p in players)})
+        self.changed(game)
+
+    async def sorceress_select(self, game, player, save):
+        await self.call_api("sorceress_select", {"game_uuid": game.uuid, "player_uuid": player.uuid,
+                                                 "save_or_kill": "True" if save else ""})
+        self.changed(game)
+
+    async def list_games(self, phase=None, prefix=None, cursor=None):
+        """
+        Une page des parties du serveur, comme Api.list_games.
+
+        Renvoie (parties, curseur de la page suivante ou None)
+        """
+        data = {}
+        if phase is not None:
+            data["phase"] = str(phase)
+        if prefix:
+            data["prefix"] = prefix
+        if cursor:
+            data["cursor"] = cursor
+
+        page = await self.call_api("list_games", data)
+        for row in page["games"]:
+            self.games_cache.seen(row["uuid"], row.get("revision", 0))
+        return [GameSummary(row, api=self) for row in page["games"]], page["cursor"]
+
+
+class AsyncPlayer(Player):
+    """
+    Comme Player, mais les parties ne sont chargées que par `await load_games()`.
+    """
+
+    def __getattr__(self, item):
+        try:
+            return self.data[item]
+        except KeyError:
+            raise AttributeError(item)
+
+    async def load_games(self):
+        api = self.data["api"]
+        for key in ("games", "games_created"):
+            games = self.data[key]
+            loaded = await asyncio.gather(*(api.get_game(game) for game in games if not isinstance(game, Game)))
+            loaded = iter(loaded)
+            self.data[key] = [game if isinstance(game, Game) else next(loaded) for game in games]
+
+
+class AsyncGame(Game):
+    """
+    Comme Game, mais les joueurs ne sont chargés que par `await load_players()`. start(), leave() et join() sont à
+    appeler avec await.
+    """
+
+    def __getattr__(self, item):
+        try:
+            return self.data[item]
+        except KeyError:
+            raise AttributeError(item)
+
+    def start(self):
+        return self.api.start_game(self)
+
+    def leave(self):
+        return self.api.leave_game(self)
+
+    def join(self):
+        return self.api.join_game(self)
+
+    def is_owned_by_me(self):
+        owner = self.data["owner"]
+        return (owner.uuid if isinstance(owner, Player) else owner) == self.api.uuid
+
+    async def load_players(self):
+        rosters = ("players", "players_killed_last_night", "players_alive")
+        uuids = [p for key in rosters for p in self.data[key] if not isinstance(p, Player)]
+        for key in ("owner", "mayor"):
+            if self.data[key] and not isinstance(self.data[key], Player):
+                uuids.append(self.data[key])
+
+        if not uuids:
+            return
+
+        players = await self.data["api"].get_players(uuids)
+
+        for key in rosters:
+            self.data[key] = [players.get(p, p) if not isinstance(p, Player) else p for p in self.data[key]]
+
+        for key in ("owner", "mayor"):
+            if self.data[key] and not isinstance(self.data[key], Player):
+                self.data[key] = players.get(self.data[key], self.data[key])
@@ -4,7 +4,7 @@ import os
 
 import time
 
-from api import Api
+from api import Api, ServerUnavailable
 
 import os
 import shlex
@@ -173,7 +173,7 @@ def game_join_menu():
     """ Cette fonction sert à rejoindre une partie en ligne """
 
     print_centered("Rejoindre une partie", full=True)
-    games = api.list_games()
+    games, _ = api.list_games(phase=0)
     for i, game in enumerate(games):
         i_plus_un = i + 1
         print_centered(f"{i_plus_un}) {game.name}")
@@ -201,7 +201,7 @@ def vote(game, question, nombre_a_tuer=1):
     :return Un object Joueur:
     """
     personnes_a_tuer = []
-    personnes_vivantes = game.players_alive
+    personnes_vivantes = list(game.players_alive)
 
     for i in range(nombre_a_tuer):
         print_centered("Quel est votre vote ?", full=True)
@@ -225,9 +225,9 @@ def in_game(game_obj):
     :param  game_obj: Object game de l'api
     """
     last_phase = 0
+    game_obj = api.get_game(game_obj.uuid, force_update=True)
 
     while True:
-        game_obj = api.get_game(game_obj.uuid, force_update=True)
         if game_obj.phase != 0:
             carte = api.get_player(api.uuid, force_update=True).cards[game_obj.uuid]
             print_centered(f"Jeu en cours : {game_obj.name}", full=True)
@@ -322,7 +322,13 @@ def in_game(game_obj):
 
         elif game_obj.phase == 99:
             print("Fin !")
-        time.sleep(1)
+
+        # Attend un changement de la partie (ou un délai) plutôt que de redemander chaque seconde
+        try:
+            game_obj = api.wait_game(game_obj)
+        except ServerUnavailable as e:
+            print(f"Le serveur ne répond plus, nouvel essai dans {e.retry_after:.0f} secondes...")
+            time.sleep(e.retry_after)
 
 
 
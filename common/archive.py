@@ -0,0 +1,106 @@
+#!/usr/bin/env python3.6
+# -*- coding:Utf-8 -*-
+"""
+Cold storage of the finished games. A while after a game finishes, it is removed from the cache and a summary of it
+(players, survivors, roles...) is appended to the archive, one JSON object per line.
+
+Only the position of each summary in the file is kept in memory. Other processes may append to the same file : the
+summaries they wrote are found by reading the end of the file when an unknown game is asked for.
+"""
+import json
+import logging
+import os
+import threading
+
+import time
+
+logger = logging.getLogger("werewolves")
+
+
+def summary(game):
+    """
+    Summary of a finished game. Its keys are a subset of Game.public_dict(), plus the roles of the players.
+    """
+    players = set(game.players) | game.players_killed_last_night | {card.owner for card in game.cards}
+    return {
+        "uuid": game.uuid,
+        "name": game.name,
+        "owner": game.owner.uuid,
+        "created_at": game.created_at,
+        "finished_at": int(time.time()),
+        "phase": game.phase,
+        "players": [p.uuid for p in players],
+        "players_alive": [p.uuid for p in game.players_alive],
+        "player_count": len(players),
+        "mayor": game.mayor.uuid if game.mayor else None,
+        "cards": [c.name for c in game.cards],
+        "roles": {p.uuid: game.role_of(p) for p in players if game in p.cards},
+    }
+
+
+class Archive:
+    """
+    Usage :
+        archive = Archive(path)
+        archive.open()
+        archive.add(game)
+        archive.get(uuid)  # The summary of the game, or None
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Game uuid -> offset of its summary in the file
+        self.offsets = {}
+        # Where the file was read up to
+        self.indexed_size = 0
+        self.file = None
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, "a+b")
+        with self.lock:
+            self._index()
+        logger.info("%s games in the archive.", len(self.offsets))
+
+    def _index(self):
+        """
+        Read the summaries appended since the last time. Must be called with the lock held.
+        """
+        self.file.seek(self.indexed_size)
+        while True:
+            offset = self.file.tell()
+            line = self.file.readline()
+            if not line.endswith(b"\n"):
+                # Nothing more, or a summary being written
+                break
+            try:
+                self.offsets[json.loads(line)["uuid"]] = offset
+            except (ValueError, KeyError):
+                logger.warning("Invalid summary at %s in %s, skipping it.", offset, self.path)
+            self.indexed_size = self.file.tell()
+
+    def add(self, game):
+        line = json.dumps(summary(game)).encode() + b"\n"
+        with self.lock:
+            # One write per summary, so summaries appended by other processes aren't mixed with ours
+            self.file.seek(0, os.SEEK_END)
+            self.file.write(line)
+            self.file.flush()
+
+    def get(self, uuid):
+        with self.lock:
+            if uuid not in self.offsets:
+                self._index()
+                if uuid not in self.offsets:
+                    return None
+
+            self.file.seek(self.offsets[uuid])
+            return json.loads(self.file.readline())
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.file = None
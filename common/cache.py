@@ -1,68 +1,413 @@
 #!/usr/bin/env python3.6
 # -*- coding:Utf-8 -*-
+import bisect
+import heapq
 import logging
+import threading
 
 import time
 
+from contextlib import contextmanager
+
 from common import objects
 
 logger = logging.getLogger("werewolves")
 MIN = 60
 HOUR = 60 * MIN
 
+ACTIVITY_BUCKET = 5 * MIN
+PLAYER_EXPIRY = 2 * HOUR
+EXPIRE_BUDGET = 100
+LIST_GAMES_PAGE = 50
+LIST_GAMES_MAX = 200
+
 
 class Cache():
+    """
+    In-memory store for players and games.
+
+    Players and games are indexed by uuid (and players by token), so lookups don't have to scan the whole store.
+    Secondary indexes are kept for games (by phase and by owner) and players (by last activity bucket). They are
+    only valid if mutations go through the add_*/remove_*/touch_player methods, or touch() of the stored objects.
+
+    If a journal (see common.persistence) is set, every change is also sent to it. If a storage (see common.storage)
+    is set, the cache is a copy of the state shared by many processes : see sync() and transaction().
+    Objects are changed by other threads (eg. the scheduler) : they must be read in reading(), eg. to serialize them.
+    If a scheduler (see common.scheduler) is set, it is told about every change of a game.
+    If an archive (see common.archive) is set, finished games are saved there when they are archived.
+    If an event log (see common.events) is set, the events of the games are saved there after each change.
+    """
+
     def __init__(self):
-        self.players = set()
-        self.games = set()
+        self.journal = None
+        self.storage = None
+        self.scheduler = None
+        self.archive = None
+        self.event_log = None
+        self.lock = threading.RLock()
+
+        self.players_by_uuid = {}
+        self.players_by_token = {}
+        self.games_by_uuid = {}
+
+        self.games_by_phase = {}
+        self.games_by_owner = {}
+        self.players_by_activity = {}
+
+        # Sorted lists, for list_games : (created_at, uuid) of the games of each phase, and (name, uuid) of all games.
+        self.games_by_created = {}
+        self.games_by_name = []
+
+        # Where each object is currently indexed, to be able to move it when it changes.
+        self._game_phase = {}
+        self._player_bucket = {}
+
+        # Min-heap of the activity buckets, oldest first. May contain buckets that were since emptied.
+        self._activity_heap = []
+
+    def sync(self):
+        """
+        Catch up with the changes made by other processes, if the state is shared.
+        """
+        if self.storage:
+            self.storage.sync()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Changes of games and players must be made in a transaction, so they are not mixed with other changes made at
+        the same time, by other threads or other processes.
+        """
+        if self.storage:
+            with self.storage.transaction(), self.lock:
+                yield
+        else:
+            with self.lock:
+                yield
+
+    @contextmanager
+    def reading(self):
+        """
+        Games and players must be read in this block when more than one of their fields is used (eg. to serialize
+        them), so they aren't changed in the middle by a transaction or a sync.
+        """
+        with self.lock:
+            yield
+
+    @property
+    def players(self):
+        return self.players_by_uuid.values()
+
+    @property
+    def games(self):
+        return self.games_by_uuid.values()
+
+    ## PLAYERS ##
+
+    def add_player(self, player: objects.Player):
+        self.players_by_uuid[player.uuid] = player
+        self.players_by_token[player.token] = player
+        player.on_change = self.player_changed
+        self._index_activity(player)
+        self.player_changed(player)
+
+    def remove_player(self, player: objects.Player):
+        self.players_by_uuid.pop(player.uuid, None)
+        self.players_by_token.pop(player.token, None)
+        player.on_change = None
+
+        if self.journal:
+            self.journal.player_removed(player)
+
+        bucket = self._player_bucket.pop(player.uuid, None)
+        if bucket is not None:
+            self._discard(self.players_by_activity, bucket, player)
+
+    def touch_player(self, player: objects.Player, now=None):
+        player.last_activity = int(now or time.time())
+        self._index_activity(player)
+
+    def index_player(self, player: objects.Player):
+        """
+        Must be called when last_activity was changed without touch_player, eg. by a storage.
+        """
+        self._index_activity(player, save=False)
+
+    def _index_activity(self, player, save=True):
+        bucket = player.last_activity // ACTIVITY_BUCKET
+        old_bucket = self._player_bucket.get(player.uuid)
+
+        if old_bucket == bucket:
+            return
+
+        if old_bucket is not None:
+            self._discard(self.players_by_activity, old_bucket, player)
+
+        if bucket not in self.players_by_activity:
+            self.players_by_activity[bucket] = set()
+            heapq.heappush(self._activity_heap, bucket)
+
+        self.players_by_activity[bucket].add(player)
+        self._player_bucket[player.uuid] = bucket
+
+        # Activity is only saved with a bucket precision, to avoid writing on every request
+        if old_bucket is not None and save:
+            self.player_changed(player)
+
+    def player_changed(self, player: objects.Player):
+        if self.journal:
+            self.journal.player_changed(player)
 
     def get_player_by_uuid(self, uuid) -> objects.Player:
-        return next((x for x in self.players if x.uuid == uuid), None)
+        return self.players_by_uuid.get(uuid)
+
+    def get_player_by_token(self, token) -> objects.Player:
+        return self.players_by_token.get(token)
+
+    ## GAMES ##
+
+    def add_game(self, game: objects.Game):
+        self.games_by_uuid[game.uuid] = game
+        self.games_by_owner.setdefault(game.owner.uuid, set()).add(game)
+        bisect.insort(self.games_by_name, (game.name.casefold(), game.uuid))
+        game.on_change = self.game_changed
+        self.game_changed(game)
+
+    def remove_game(self, game: objects.Game):
+        self.games_by_uuid.pop(game.uuid, None)
+        self._discard(self.games_by_owner, game.owner.uuid, game)
+        game.on_change = None
+
+        if self.journal:
+            self.journal.game_removed(game)
+
+        self._remove_sorted(self.games_by_name, (game.name.casefold(), game.uuid))
+
+        phase = self._game_phase.pop(game.uuid, None)
+        if phase is not None:
+            self._discard(self.games_by_phase, phase, game)
+            self._remove_sorted(self.games_by_created[phase], (game.created_at, game.uuid))
+
+    def game_changed(self, game: objects.Game):
+        if game.events:
+            if self.event_log:
+                self.event_log.write(game.uuid, game.events)
+            game.events.clear()
+
+        self.reindex_game(game)
+
+        if self.journal:
+            self.journal.game_changed(game)
+
+    def reindex_game(self, game: objects.Game):
+        """
+        Called after each change of the game, as the phase may have changed (start, tick...)
+        """
+        if self.scheduler:
+            self.scheduler.game_changed(game)
+
+        old_phase = self._game_phase.get(game.uuid)
+
+        if old_phase == game.phase:
+            return
+
+        if old_phase is not None:
+            self._discard(self.games_by_phase, old_phase, game)
+            self._remove_sorted(self.games_by_created[old_phase], (game.created_at, game.uuid))
+
+        self.games_by_phase.setdefault(game.phase, set()).add(game)
+        bisect.insort(self.games_by_created.setdefault(game.phase, []), (game.created_at, game.uuid))
+        self._game_phase[game.uuid] = game.phase
+
+    def change_owner(self, game: objects.Game, owner: objects.Player, save=True):
+        """
+        Give the game to another player. If `save` is False, the change isn't recorded (eg. loaded from a storage).
+        """
+        self._discard(self.games_by_owner, game.owner.uuid, game)
+        self.games_by_owner.setdefault(owner.uuid, set()).add(game)
+        if save:
+            game.set_owner(owner)
+        else:
+            game.owner = owner
 
     def get_game_by_uuid(self, uuid) -> objects.Game:
-        return next((x for x in self.games if x.uuid == uuid), None)
+        return self.games_by_uuid.get(uuid)
+
+    def archive_game(self, game: objects.Game):
+        """
+        Remove a finished game from the cache, and save its summary in the archive. It moves to the history of its
+        players.
+        """
+        if self.archive:
+            self.archive.add(game)
+
+        players = set(game.players) | game.players_killed_last_night | {c.owner for c in game.cards} | {game.owner}
+        self.remove_game(game)
+        for player in players:
+            player.forget_game(game)
+
+    def get_archived_game(self, uuid):
+        """
+        Summary of an archived game (see common.archive.summary), or None.
+        """
+        if self.archive:
+            return self.archive.get(uuid)
+        return None
+
+    def get_games_by_phase(self, phase):
+        return self.games_by_phase.get(phase, set())
+
+    def get_games_by_owner(self, owner: objects.Player):
+        return self.games_by_owner.get(owner.uuid, set())
+
+    def count_active_players(self, period=ACTIVITY_BUCKET, now=None):
+        """
+        Number of players active in the last `period` seconds, rounded to whole activity buckets.
+        """
+        if now is None:
+            now = time.time()
+        first_bucket = (now - period) // ACTIVITY_BUCKET
+        return sum(len(players) for bucket, players in list(self.players_by_activity.items()) if bucket >= first_bucket)
+
+    def list_games(self, phases=None, prefix=None, cursor=None, limit=LIST_GAMES_PAGE, newest_first=True):
+        """
+        Games of the given phases (all if None), whose name starts with `prefix` (case insensitive), sorted by creation
+        time.
+
+        `cursor` is the (created_at, uuid) of the last game of the previous page. Returns a page of at most `limit`
+        games, and the cursor of the next page (None if this is the last one).
+        """
+        if phases is None:
+            phases = list(self.games_by_created.keys())
+
+        def after_cursor(key):
+            if cursor is None:
+                return True
+            return key < cursor if newest_first else key > cursor
+
+        if prefix:
+            # Few games share a prefix : sort the matches
+            prefix = prefix.casefold()
+            start = bisect.bisect_left(self.games_by_name, (prefix,))
+            keys = []
+            for name, uuid in self.games_by_name[start:]:
+                if not name.startswith(prefix):
+                    break
+                game = self.games_by_uuid[uuid]
+                key = (game.created_at, uuid)
+                if self._game_phase.get(uuid) in phases and after_cursor(key):
+                    keys.append(key)
+            keys.sort(reverse=newest_first)
+            keys = iter(keys)
+        else:
+            # Merge the sorted lists of the phases, starting from the cursor. No more than limit + 1 games are needed
+            # from each list.
+            lists = []
+            for phase in phases:
+                created = self.games_by_created.get(phase, [])
+                if newest_first:
+                    end = bisect.bisect_left(created, cursor) if cursor else len(created)
+                    lists.append(created[max(end - limit - 1, 0):end][::-1])
+                else:
+                    start = bisect.bisect_right(created, cursor) if cursor else 0
+                    lists.append(created[start:start + limit + 1])
+            keys = heapq.merge(*lists, reverse=newest_first)
+
+        games = []
+        for key in keys:
+            if len(games) == limit:
+                return games, (games[-1].created_at, games[-1].uuid)
+            games.append(self.games_by_uuid[key[1]])
+        return games, None
+
+    @staticmethod
+    def _remove_sorted(items, item):
+        i = bisect.bisect_left(items, item)
+        if i < len(items) and items[i] == item:
+            del items[i]
+
+    @staticmethod
+    def _discard(index, key, item):
+        items = index.get(key)
+        if items is not None:
+            items.discard(item)
+            if not items:
+                del index[key]
+
+    ## AUTH ##
 
     def get_user_from_auth(self, uuid, token):
-        #self.purge()
-        player = self.get_player_by_uuid(uuid)
-
-        try:
-            if player.token == token:
-                return player
-            else:
-                return False
-        except:
+        player = self.get_player_by_token(token)
+
+        if player and player.uuid == uuid:
+            return player
+        else:
             return False
 
-    def purge(self):
-        #logger.debug("Purge starting")
-        time_start = time.time()
+    ## EXPIRY ##
+
+    def expire(self, now=None, budget=EXPIRE_BUDGET):
+        """
+        Remove players that were inactive for more than PLAYER_EXPIRY, and the games they leave empty.
+
+        Only the oldest activity buckets are looked at, and at most `budget` players are removed per call (None for no
+        limit). Must be called in a transaction, as the players leave their games : see PhaseScheduler, that calls it
+        regularly.
+
+        Returns the number of players and games removed.
+        """
+        now = int(now or time.time())
+        # A bucket is only expired once all of it is older than the expiry time.
+        last_expired_bucket = (now - PLAYER_EXPIRY) // ACTIVITY_BUCKET - 1
         players_deleted = 0
         games_deleted = 0
-        expiry_time = int(time.time()) - 2 * HOUR
-        for player in list(self.players):
-            if player.last_activity <= expiry_time:
-                afk_minutes = int(time.time() - player.last_activity)/60
-                # logger.debug(f"Purge of player {player.display_name} (AFK for {afk_minutes}):")
-                for game_played in player.games:
-                    game_played.players.remove(player)
-                    # logger.debug(f"\t1)\tRemoved player {player.display_name} from game {game_played.display_name}.")
-
-                self.players.remove(player)
+
+        while self._activity_heap and self._activity_heap[0] <= last_expired_bucket:
+            bucket = self._activity_heap[0]
+            players = self.players_by_activity.get(bucket)
+
+            if not players:
+                heapq.heappop(self._activity_heap)
+                continue
+
+            while players:
+                if budget is not None and players_deleted >= budget:
+                    return players_deleted, games_deleted
+
+                player = next(iter(players))
+                games_deleted += self._expire_player(player)
                 players_deleted += 1
-                # logger.debug(f"\t2)\tDeleted player {player.display_name} from cache")
 
-        for game in list(self.games):
+        if players_deleted:
+            logger.debug("Expired %s players and %s games.", players_deleted, games_deleted)
+
+        return players_deleted, games_deleted
+
+    def _expire_player(self, player):
+        games_deleted = 0
+        for game in list(player.games | player.games_created):
+            if game.uuid not in self.games_by_uuid:
+                continue
+
+            # Like a player leaving : the game is saved, its waiters woken up and it is rescheduled
+            if player in game.players:
+                game.leave(player)
             if len(game.players) == 0:
-                self.games.remove(game)
+                self.remove_game(game)
                 games_deleted += 1
-                # logger.debug(f"Removed game {game.display_name}.")
-
+            elif game.owner is player:
+                # The game goes on without its owner : it is given to another player, so it can be loaded again
+                self.change_owner(game, min(game.players, key=lambda p: p.uuid))
 
-        time_stop = time.time()
+        self.remove_player(player)
+        return games_deleted
 
-        time_taken = round(time_stop-time_start, 3)
+    def purge(self):
+        time_start = time.time()
 
-        logger.debug(f"Purge finished. Removed {players_deleted} players and {games_deleted} games, in {time_taken} seconds.")
+        players_deleted, games_deleted = self.expire(budget=None)
 
+        time_taken = round(time.time() - time_start, 3)
 
+        logger.debug("Purge finished. Removed %s players and %s games, in %s seconds.", players_deleted, games_deleted,
+                     time_taken)
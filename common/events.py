@@ -0,0 +1,216 @@
+#!/usr/bin/env python3.6
+# -*- coding:Utf-8 -*-
+"""
+History of the games, as a log of events per game. Every change of a game is recorded by Game.emit() as a tuple
+(kind, time, *arguments) :
+
+    ("created", time, name, owner uuid, owner name, created_at)
+    ("joined", time, player uuid, player name)
+    ("left", time, player uuid)
+    ("started", time, deadline, [(player uuid, card name), ...])
+    ("phase", time, phase, deadline, first_night)
+    ("voted", time, player uuid, [selected players uuid])
+    ("votes_cleared", time)
+    ("mayor", time, player uuid)
+    ("card", time, player uuid, index of the card in the game cards)
+    ("killed", time, player uuid, killed last night)
+    ("revived", time, player uuid)
+    ("lovers", time, [players uuid])
+    ("owner", time, player uuid)
+    ("potion", time, player uuid, "heal" or "kill")
+
+The cache gives the events of a game to the EventStore after each change of the game, and the store appends them to the
+game's file, one JSON array per line. replay() builds the game back from its events, to look at what happened in a game
+or to get it back after a crash. From the root of the repository :
+
+    python3 -m common.events data/events <game uuid>
+"""
+import json
+import logging
+import os
+import sys
+
+import time
+
+from common import objects
+
+logger = logging.getLogger("werewolves")
+
+
+KINDS = ("created", "joined", "left", "started", "phase", "voted", "votes_cleared", "mayor", "card", "killed",
+         "revived", "lovers", "potion", "owner")
+
+
+## REPLAY ##
+
+
+class _Replay:
+    def __init__(self, uuid, players):
+        self.uuid = uuid
+        self.players = players
+        self.game = None
+
+    def player(self, uuid, name=None):
+        player = self.players.get(uuid)
+        if player is None:
+            player = self.players[uuid] = objects.Player(name or uuid, uuid)
+        return player
+
+    def created(self, name, owner_uuid, owner_name, created_at):
+        self.game = objects.Game(name, self.player(owner_uuid, owner_name), self.uuid)
+        # Replayed changes aren't recorded again
+        self.game.events = None
+        self.game.created_at = created_at
+
+    def joined(self, uuid, name):
+        player = self.player(uuid, name)
+        self.game.players.add(player)
+        player.games.add(self.game)
+        player.current_game = self.game
+
+    def left(self, uuid):
+        player = self.player(uuid)
+        self.game.players.discard(player)
+        player.current_game = None
+
+    def started(self, deadline, cards):
+        game = self.game
+        for uuid, name in cards:
+            card = objects.Card(self.player(uuid), name)
+            card.owner.cards[game] = card
+            game.cards.append(card)
+        game.phase = game.STATE_STARTED
+        game.need_to_complete_phase_before = deadline
+        game.players_alive = game.players
+        game.reindex()
+
+    def phase(self, phase, deadline, first_night):
+        self.game.phase = phase
+        self.game.need_to_complete_phase_before = deadline
+        self.game.first_night = first_night
+
+    def voted(self, uuid, players_uuid):
+        player = self.player(uuid)
+        self.game.votes[player] = set(players_uuid)
+        self.game._tally_vote(player)
+
+    def votes_cleared(self):
+        self.game.clear_votes()
+
+    def mayor(self, uuid):
+        self.game.mayor = self.player(uuid)
+
+    def card(self, uuid, index):
+        self.game.set_card(self.player(uuid), self.game.cards[index])
+
+    def killed(self, uuid, last_night):
+        self.game.kill(self.player(uuid), last_night)
+
+    def revived(self, uuid):
+        self.game.revive(self.player(uuid))
+
+    def lovers(self, players_uuid):
+        lovers = [self.player(uuid) for uuid in players_uuid]
+        for lover in lovers:
+            lover.love = lovers
+
+    def owner(self, uuid):
+        self.game.owner = self.player(uuid)
+
+    def potion(self, uuid, potion):
+        setattr(self.player(uuid).cards[self.game], f"{potion}_potion", False)
+
+
+def replay(uuid, events, players=None):
+    """
+    Build the game `uuid` back from its events.
+
+    `players` maps uuids to the Player objects to use (eg. the players of a cache) : they are changed like during the
+    game (cards, lovers...). The players that aren't in it are created, and added to it.
+
+    The revision of the game starts back from 0, so clients get a full copy of the game.
+    """
+    state = _Replay(uuid, {} if players is None else players)
+    handlers = {kind: getattr(state, kind) for kind in KINDS}
+
+    for event in events:
+        # event[1] is the time of the event
+        handlers[event[0]](*event[2:])
+
+    game = state.game
+    if game is None:
+        raise ValueError(f"No creation event for game {uuid}.")
+    game.events = []
+    game.reset_changes()
+    return game
+
+
+## STORE ##
+
+
+class EventStore:
+    """
+    Append-only log of the events of each game, in a directory holding a file per game.
+
+    Usage :
+        store = EventStore(path)
+        store.open()
+        cache.event_log = store  # Writes the events of the games of the cache
+        store.read(uuid)  # The events of the game
+        store.replay(uuid)  # The game, built from its events
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    def _game_path(self, uuid):
+        if os.sep in uuid or uuid.startswith("."):
+            raise ValueError(f"Invalid game uuid {uuid!r}")
+        return os.path.join(self.path, f"{uuid}.jsonl")
+
+    def write(self, uuid, events):
+        data = "".join(json.dumps(event, separators=(",", ":")) + "\n" for event in events).encode()
+        # A single write in append mode, so events written by other processes aren't mixed with these
+        with open(self._game_path(uuid), "ab") as f:
+            f.write(data)
+
+    def read(self, uuid):
+        """
+        Events of the game, oldest first, or an empty list if it has none.
+        """
+        try:
+            with open(self._game_path(uuid), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+
+        lines = data.split(b"\n")
+        # The last line is empty, or an event that was being written
+        if lines[-1]:
+            logger.warning("Incomplete event at the end of the log of game %s, skipping it.", uuid)
+        # Parsed at once, much faster than line by line
+        return json.loads(b"[" + b",".join(lines[:-1]) + b"]")
+
+    def replay(self, uuid, players=None):
+        events = self.read(uuid)
+        if not events:
+            return None
+        return replay(uuid, events, players)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage : python3 -m common.events <events directory> <game uuid>")
+        sys.exit(2)
+
+    store = EventStore(sys.argv[1])
+    start = time.perf_counter()
+    events = store.read(sys.argv[2])
+    game = replay(sys.argv[2], events)
+    duration = time.perf_counter() - start
+
+    print(json.dumps(game.public_dict(), indent=2))
+    print(f"{len(events)} events replayed in {duration * 1000:.1f} ms")
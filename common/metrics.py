@@ -0,0 +1,134 @@
+#!/usr/bin/env python3.6
+# -*- coding:Utf-8 -*-
+"""
+In-process metrics of the server : counters and latency histograms per route, error counters.
+
+Recording is a few dict operations under a lock, so it can be done on every request.
+"""
+import bisect
+import threading
+
+# Upper bounds of the latency histogram buckets, in seconds. The last bucket has no upper bound.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Route of the requests to unknown paths
+OTHER_ROUTE = "other"
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.sum = 0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimate the q-quantile (0 < q < 1), interpolating linearly in the bucket it falls in.
+        """
+        if not self.total:
+            return None
+
+        rank = q * self.total
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0
+                upper = self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.bounds[-1]
+
+
+class Metrics:
+    def __init__(self, routes=None):
+        # Known routes. Requests to other paths are all counted under OTHER_ROUTE, or every path requested would get
+        # its own counters and histogram. None to count each path under its own route.
+        self.routes = routes
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.errors = {}
+        self.latencies = {}
+        # Route of the request handled by each thread, to know where errors come from
+        self.current = threading.local()
+
+    def route(self, path):
+        """
+        The route to count a request to `path` under.
+        """
+        if self.routes is None or path in self.routes:
+            return path
+        return OTHER_ROUTE
+
+    def start_request(self, path):
+        self.current.route = self.route(path)
+
+    def record_request(self, path, status_code, duration):
+        route = self.route(path)
+        with self.lock:
+            self.requests[(route, status_code)] = self.requests.get((route, status_code), 0) + 1
+            if route not in self.latencies:
+                self.latencies[route] = Histogram()
+            self.latencies[route].record(duration)
+
+    def record_error(self, name):
+        key = (getattr(self.current, "route", None), name)
+        with self.lock:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def summary(self):
+        """
+        Returns a dict with, for each route, the request counts by status, errors, and latency percentiles in ms.
+        """
+        routes = {}
+        with self.lock:
+            for (route, status_code), count in self.requests.items():
+                route_summary = routes.setdefault(route, {"requests": {}, "errors": {}})
+                route_summary["requests"][str(status_code)] = count
+
+            for (route, name), count in self.errors.items():
+                routes.setdefault(route, {"requests": {}, "errors": {}})["errors"][name] = count
+
+            for route, histogram in self.latencies.items():
+                for q in (0.5, 0.95, 0.99):
+                    routes[route][f"p{int(q * 100)}_ms"] = round(histogram.quantile(q) * 1000, 2)
+
+        return routes
+
+    def text(self, gauges=None):
+        """
+        Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            lines.append("# TYPE werewolves_requests_total counter")
+            for (route, status_code), count in sorted(self.requests.items()):
+                lines.append(f'werewolves_requests_total{{route="{route}",status="{status_code}"}} {count}')
+
+            lines.append("# TYPE werewolves_errors_total counter")
+            for (route, name), count in sorted(self.errors.items(), key=str):
+                lines.append(f'werewolves_errors_total{{route="{route}",error="{name}"}} {count}')
+
+            lines.append("# TYPE werewolves_request_duration_seconds histogram")
+            for route, histogram in sorted(self.latencies.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.bounds + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f'werewolves_request_duration_seconds_bucket{{route="{route}",le="{bound}"}} '
+                                 f'{cumulative}')
+                lines.append(f'werewolves_request_duration_seconds_sum{{route="{route}"}} {histogram.sum}')
+                lines.append(f'werewolves_request_duration_seconds_count{{route="{route}"}} {histogram.total}')
+
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE werewolves_{name} gauge")
+            if isinstance(value, dict):
+                for label, label_value in sorted(value.items()):
+                    lines.append(f'werewolves_{name}{{key="{label}"}} {label_value}')
+            else:
+                lines.append(f"werewolves_{name} {value}")
+
+        return "\n".join(lines) + "\n"
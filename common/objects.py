@@ -3,6 +3,8 @@
 import collections
 import logging
 import random
+import sys
+import threading
 from uuid import uuid4
 
 import time
@@ -14,6 +16,12 @@ MINUTE = SECOND * 60
 HOUR = MINUTE * 60
 DAY = HOUR * 24
 
+# Number of revisions a game keeps in its change log. Clients further behind get a full snapshot.
+CHANGELOG_SIZE = 64
+# Number of archived games a player remembers, and of games returned per page of their history.
+PLAYER_HISTORY_SIZE = 100
+HISTORY_PAGE = 20
+
 
 class Game:
     """
@@ -30,35 +38,350 @@ class Game:
 
         Other numbers are reserved for future use.
     """
-
-    def __init__(self, name, owner):
-        self.STATE_NOT_STARTED = 0
-        self.STATE_STARTED = 1
-        self.STATE_NIGHT_STEALER = 10
-        self.STATE_NIGHT_CUPID = 11
-        self.STATE_NIGHT_WEREWOLVES = 12
-        self.STATE_NIGHT_SORCERESS = 13
-        self.STATE_DAY_VOTE = 20
-        self.STATE_DAY_HUNTER = 21
-        self.STATE_FINISHED = 99
+    STATE_NOT_STARTED = 0
+    STATE_STARTED = 1
+    STATE_NIGHT_STEALER = 10
+    STATE_NIGHT_CUPID = 11
+    STATE_NIGHT_WEREWOLVES = 12
+    STATE_NIGHT_SORCERESS = 13
+    STATE_DAY_VOTE = 20
+    STATE_DAY_HUNTER = 21
+    STATE_FINISHED = 99
+
+    # There are a lot of games in memory : no __dict__ per game.
+    __slots__ = ("first_night", "players", "players_alive", "name", "uuid", "phase", "need_to_complete_phase_before",
+                 "created_at", "owner", "cards", "votes", "alive_by_uuid", "roles", "tally", "werewolf_tally",
+                 "players_killed_last_night", "mayor", "pristress_last_used", "revision", "changed", "changelog",
+                 "_last_fields", "_added", "_removed", "_cards_changed", "on_change", "events")
+
+    def __init__(self, name, owner, uuid=None):
         self.first_night = True
         self.players = set()
         self.players_alive = set()
         self.name = name
-        self.uuid = str(uuid4())
-        self.display_name = f"{self.name} §({self.uuid})"
+        self.uuid = uuid or str(uuid4())
         self.phase = 0
         self.need_to_complete_phase_before = 0
         self.created_at = int(time.time())
         self.owner = owner
         self.cards = []
         self.votes = {}
+        # Alive players by uuid and by role, and the votes counts, so phase checks and votes don't scan the players.
+        self.alive_by_uuid = {}
+        self.roles = {}
+        self.tally = VoteTally()
+        self.werewolf_tally = VoteTally()
         self.players_killed_last_night = set()
         self.mayor = None
         self.pristress_last_used = 0
+        # Bumped on every change of the game state, waiters on `changed` are notified.
+        self.revision = 0
+        self.changed = threading.Condition()
+        self.changelog = collections.deque(maxlen=CHANGELOG_SIZE)
+        # What changed since the last logged change : the fields as they were, the uuids added to and removed from
+        # each roster, and if the cards changed. The rosters are too big to be compared on every change.
+        self._last_fields = self._fields()
+        self._added = {}
+        self._removed = {}
+        self._cards_changed = False
+        # Called with the game after each change, set by the cache storing the game.
+        self.on_change = None
+        # Events not yet saved (see common.events). The cache takes them after each change. None while replaying.
+        self.events = []
+        self.emit("created", name, owner.uuid, owner.name, self.created_at)
+
+    ROSTERS = ("players", "players_alive", "players_killed_last_night")
+
+    @property
+    def display_name(self):
+        return f"{self.name} §({self.uuid})"
+
+    def _fields(self):
+        return {
+            "owner": self.owner.uuid,
+            "phase": self.phase,
+            "mayor": self.mayor.uuid if self.mayor else None,
+            "need_to_complete_phase_before": self.need_to_complete_phase_before,
+            "player_count": len(self.players),
+        }
+
+    def _record(self, members, player, added):
+        """
+        Note for the change log that `player` was added to or removed from `members`. After the start, players_alive
+        is the players set itself : the change is recorded for every roster that is `members`.
+        """
+        for key in self.ROSTERS:
+            if getattr(self, key) is members:
+                self._record_uuid(key, player.uuid, added)
+
+    def _record_uuid(self, key, uuid, added):
+        same, opposite = (self._added, self._removed) if added else (self._removed, self._added)
+        # Added then removed (or the other way round) since the last logged change : nothing changed
+        if uuid in opposite.get(key, ()):
+            opposite[key].discard(uuid)
+        else:
+            same.setdefault(key, set()).add(uuid)
+
+    def set_roster(self, key, members):
+        """
+        Replace one of the ROSTERS, and record the players added and removed for the change log.
+        """
+        old = {p.uuid for p in getattr(self, key)}
+        new = {p.uuid for p in members}
+        setattr(self, key, members)
+        for uuid in new - old:
+            self._record_uuid(key, uuid, True)
+        for uuid in old - new:
+            self._record_uuid(key, uuid, False)
+
+    def cards_changed(self):
+        """
+        Must be called when the cards were given out or replaced, for the change log.
+        """
+        self._cards_changed = True
+
+    def reset_changes(self):
+        """
+        Forget the changes not logged yet, eg. once the game was built back from its events.
+        """
+        self._last_fields = self._fields()
+        self._added = {}
+        self._removed = {}
+        self._cards_changed = False
+
+    def emit(self, kind, *args):
+        """
+        Record a change of the game, as an event (kind, time, *args). See common.events for the kinds of events.
+        """
+        if self.events is not None:
+            self.events.append((kind, int(time.time())) + args)
+
+    def touch(self):
+        with self.changed:
+            self.revision += 1
+            self.log_change(self.revision - 1)
+
+        if self.on_change:
+            self.on_change(self)
+
+    def log_change(self, base_revision):
+        """
+        Add what changed since `base_revision` (the state we last logged) to the change log, and wake up the waiters.
+        Must be called with the `changed` lock held, once the revision was updated.
+        """
+        state = self._fields()
+        fields = {key: value for key, value in state.items() if value != self._last_fields[key]}
+        if self._cards_changed:
+            fields["cards"] = tuple(c.name for c in self.cards)
+        # Tuples rather than sets : up to CHANGELOG_SIZE changes are kept for every game
+        added = {key: tuple(uuids) for key, uuids in self._added.items() if uuids}
+        removed = {key: tuple(uuids) for key, uuids in self._removed.items() if uuids}
+
+        self.changelog.append((base_revision, self.revision, added, removed, fields))
+        self.reset_changes()
+
+        self.changed.notify_all()
+
+    def changes_since(self, revision):
+        """
+        Return a delta dict with what changed in public_dict() since `revision`, or None if the change log doesn't go
+        back that far.
+        """
+        with self.changed:
+            if revision > self.revision:
+                return None
+
+            added = {key: set() for key in self.ROSTERS}
+            removed = {key: set() for key in self.ROSTERS}
+            fields = {}
+            base = revision
+
+            for change_base, change_revision, change_added, change_removed, change_fields in self.changelog:
+                if change_revision <= revision:
+                    continue
+
+                # Changes must follow each other from `revision`, or we can't tell what the client has.
+                if change_base != base:
+                    return None
+                base = change_revision
+
+                for key, uuids in change_added.items():
+                    removed[key].difference_update(uuids)
+                    added[key].update(uuids)
+                for key, uuids in change_removed.items():
+                    added[key].difference_update(uuids)
+                    removed[key].update(uuids)
+                fields.update(change_fields)
+
+            if base != self.revision:
+                return None
+
+        return {
+            "delta": True,
+            "base_revision": revision,
+            "revision": self.revision,
+            "uuid": self.uuid,
+            "added": {key: list(uuids) for key, uuids in added.items() if uuids},
+            "removed": {key: list(uuids) for key, uuids in removed.items() if uuids},
+            "set": fields,
+        }
+
+    def wait_for_change(self, revision, timeout):
+        """
+        Block until the game revision is different from `revision` or `timeout` seconds elapsed.
+        """
+        with self.changed:
+            return self.changed.wait_for(lambda: self.revision != revision, timeout)
+
+    def etag(self, with_players=False):
+        """
+        Version tag of public_dict(). time_left is left out : clients should compute it from
+        need_to_complete_phase_before.
+
+        If `with_players` is True, the tag also changes when a player profile changes. Revisions only go up, so their
+        sum is enough for that.
+        """
+        if with_players:
+            return f'"{self.uuid}-{self.revision}-{sum(p.revision for p in self.players)}"'
+        return f'"{self.uuid}-{self.revision}"'
+
+    def join(self, player):
+        if player not in self.players:
+            self.players.add(player)
+            self._record(self.players, player, True)
+        player.games.add(self)
+        player.current_game = self
+        self.emit("joined", player.uuid, player.name)
+        player.touch()
+        self.touch()
+
+    def leave(self, player):
+        self.kill(player)
+        # After the start, players_alive may be the players set itself
+        if player in self.players:
+            self.players.discard(player)
+            self._record(self.players, player, False)
+        player.current_game = None
+        self.emit("left", player.uuid)
+        player.touch()
+        self.touch()
+
+    def set_owner(self, player):
+        self.owner = player
+        self.emit("owner", player.uuid)
+        self.touch()
+
+    def vote(self, player, players_uuid):
+        self.votes[player] = players_uuid
+        self._tally_vote(player)
+        self.emit("voted", player.uuid, list(players_uuid))
+        self.touch()
+
+    def _tally_vote(self, player):
+        # Only the first player selected counts in the tally
+        target = next(iter(self.votes[player]), None)
+        if target is None:
+            self.tally.remove(player)
+            self.werewolf_tally.remove(player)
+            return
+
+        self.tally.add(player, target)
+        if player in self.roles.get("werewolve", ()):
+            self.werewolf_tally.add(player, target)
+
+    def clear_votes(self):
+        votes = self.votes
+        self.votes = {}
+        self.tally.clear()
+        self.werewolf_tally.clear()
+        if votes:
+            self.emit("votes_cleared")
+        return votes
+
+    @property
+    def werewolves_voted(self):
+        return len(self.werewolf_tally)
+
+    ## ROLES ##
+
+    def role_of(self, player):
+        return str(player.cards.get(self))
+
+    def _index_alive(self, player):
+        self.alive_by_uuid[player.uuid] = player
+        if self in player.cards:
+            self.roles.setdefault(self.role_of(player), set()).add(player)
+            if player in self.votes and self.role_of(player) == "werewolve":
+                self._tally_vote(player)
+
+    def _unindex_alive(self, player):
+        self.alive_by_uuid.pop(player.uuid, None)
+        players = self.roles.get(self.role_of(player))
+        if players and player in players:
+            players.discard(player)
+            self.werewolf_tally.remove(player)
+
+    def reindex(self):
+        """
+        Rebuild the alive players and roles indexes, and the vote tallies, from players_alive, the cards and the votes.
+        Needed when they were set directly.
+        """
+        self.alive_by_uuid = {}
+        self.roles = {}
+        self.tally.clear()
+        self.werewolf_tally.clear()
+        for player in self.players_alive:
+            self._index_alive(player)
+        for player in self.votes:
+            self._tally_vote(player)
+
+    def set_card(self, player, card):
+        alive = player in self.players_alive
+        if alive:
+            self._unindex_alive(player)
+        player.cards[self] = card
+        if alive:
+            self._index_alive(player)
+        self.emit("card", player.uuid, self.cards.index(card))
+
+    def kill(self, player, last_night=False):
+        """
+        `last_night` : the player was killed during the night, and can be saved by the sorceress.
+        """
+        if player in self.players_alive:
+            self._unindex_alive(player)
+            self.players_alive.discard(player)
+            self._record(self.players_alive, player, False)
+            if last_night and player not in self.players_killed_last_night:
+                self.players_killed_last_night.add(player)
+                self._record(self.players_killed_last_night, player, True)
+            self.emit("killed", player.uuid, last_night)
+
+    def revive(self, player):
+        if player not in self.players_alive:
+            self.players_alive.add(player)
+            self._record(self.players_alive, player, True)
+            if player in self.players_killed_last_night:
+                self.players_killed_last_night.discard(player)
+                self._record(self.players_killed_last_night, player, False)
+            self._index_alive(player)
+            self.emit("revived", player.uuid)
+
+    def use_potion(self, player, potion):
+        """
+        Use the "heal" or "kill" potion of the player's card. Returns False if they don't have it (anymore).
+        """
+        card = player.cards[self]
+        attribute = f"{potion}_potion"
+        if not getattr(card, attribute):
+            return False
+        setattr(card, attribute, False)
+        self.emit("potion", player.uuid, potion)
+        return True
 
     def public_dict(self):
         return {
+            "revision": self.revision,
             "phase": self.phase,
             "players": [p.uuid for p in self.players],
             "players_alive": [p.uuid for p in self.players_alive],
@@ -68,27 +391,24 @@ class Game:
             "uuid": self.uuid,
             "owner": self.owner.uuid,
             "created_at": self.created_at,
+            "need_to_complete_phase_before": self.need_to_complete_phase_before,
             "time_left": int(self.need_to_complete_phase_before - time.time()),
             "player_count": len(self.players),
             "mayor": self.mayor.uuid if self.mayor else None
         }
 
     def get_player_with_card(self, card):
-        for player in self.players_alive:
-            if str(player.cards[self]) == str(card):
-                return player
+        for player in self.roles.get(str(card), ()):
+            return player
 
         return None
 
     def get_player_with_uuid(self, uuid):
-        for player in self.players_alive:
-            if str(player.uuid) == uuid:
-                return player
-        return None
+        return self.alive_by_uuid.get(uuid)
 
     def get_votes(self, count_only_werewolves=False, player=None, number_required=1):
         if player:
-            player_votes = set(self.votes[player])
+            player_votes = {self.alive_by_uuid[u] for u in self.votes.get(player, ()) if u in self.alive_by_uuid}
 
             if number_required >= len(self.players_alive):
                 raise Exception("NotEnoughPlayers")
@@ -98,39 +418,43 @@ class Game:
 
             return list(player_votes)[:number_required]
 
-        cnt = collections.Counter()
-
-        keys = []
-
-        if count_only_werewolves:
-            for player in self.votes.keys():
-                if player.cards[self].name == "werewolve":
-                    keys.append(player)
+        tally = self.werewolf_tally if count_only_werewolves else self.tally
 
+        leaders = [self.alive_by_uuid[u] for u in tally.leaders() if u in self.alive_by_uuid]
+        if leaders:
+            # Ties are broken at random
+            most_common = random.choice(leaders)
+            voted = tally.max
         else:
-            keys = self.votes.keys()
-
-        most_common = random.choice(list(self.players_alive))
-        voted = 0
-        if keys:
-            for player in keys:
-                vote_uuid = list(self.votes[player])[0]
-                vote = self.get_player_with_uuid(vote_uuid)
-                if vote:
-                    cnt[vote] += 1
-                    most_common, voted = cnt.most_common(1)[0]
-
-        logger.info(
-            f"Votes ({self.votes}) for game {self.display_name} selected {most_common} with {voted} votes. Clearing them.")
-        votes = self.votes
-        self.votes = {}
+            # The leaders died since they were voted for : look for the best alive target
+            alive_counts = [(c, u) for u, c in tally.counts.items() if u in self.alive_by_uuid]
+            if alive_counts:
+                voted, uuid = max(alive_counts)
+                most_common = self.alive_by_uuid[uuid]
+            else:
+                most_common = random.choice(list(self.players_alive))
+                voted = 0
+
+        logger.info("Votes (%s) for game %s selected %s with %s votes. Clearing them.", self.votes, self.display_name,
+                    most_common, voted)
+        votes = self.clear_votes()
 
         return most_common, votes
 
     def tick(self, force=False):
+        before = (self.phase, self.need_to_complete_phase_before)
+        self._tick(force)
+        if (self.phase, self.need_to_complete_phase_before) != before:
+            self.emit("phase", self.phase, self.need_to_complete_phase_before, self.first_night)
+            self.touch()
+
+    def should_tick(self, force=False):
+        """
+        Return True if tick() would change the game : the phase deadline passed, or every vote needed is in.
+        """
         current_time = int(time.time())
-        if self.phase == 0:
-            return
+        if self.phase == 0 or self.phase == self.STATE_FINISHED:
+            return False
 
         if len(self.votes) == len(self.players_alive):
             force = True
@@ -146,167 +470,324 @@ class Game:
                 force = True
 
         if self.phase == self.STATE_NIGHT_WEREWOLVES:
-            for player in self.players_alive:
-                if str(player.cards[self]) == str("werewolve"):
-                    if player not in self.votes.keys():
-                        break
-            else:
+            if self.werewolves_voted == len(self.roles.get("werewolve", ())):
                 force = True
 
         if len(self.players_alive) <= 1:
-            self.phase = 99
-            return
-
-        if self.need_to_complete_phase_before < current_time or force:
-            # most_common, votes = self.get_votes()
-
-            cards = [c.cards[self].name for c in self.players_alive]
-            logger.info(f"Game {self.display_name} finished phase {self.phase}, ticking.")
-            if self.phase <= self.STATE_STARTED and self.first_night:
-                self.mayor, votes = self.get_votes()
-                logger.debug(f"{self.display_name} now have {self.mayor.display_name} as a mayor")
+            return True
 
-                # self.mayor = self.get_player_with_uuid(most_common)
+        return self.need_to_complete_phase_before < current_time or force
 
-                if "stealer" in cards:
-                    self.need_to_complete_phase_before = current_time + 1 * MINUTE
-                    self.phase = self.STATE_NIGHT_STEALER
-                    return
+    def _tick(self, force=False):
+        current_time = int(time.time())
+        if not self.should_tick(force):
+            return
 
-            if self.phase <= self.STATE_NIGHT_STEALER and self.first_night:
-                if "stealer" in cards:
-                    stealer = self.get_player_with_card("stealer")
-                    player_stolen = self.get_votes(stealer, number_required=1)[0]
-                    stealer.cards[self] = player_stolen.cards[self]
-                    player_stolen.cards[self] = "stealer"
+        if len(self.players_alive) <= 1:
+            self.phase = 99
+            return
 
-                if "cupid" in cards:
-                    self.need_to_complete_phase_before = current_time + 1 * MINUTE
-                    self.get_votes()  # Reset votes
-                    self.phase = self.STATE_NIGHT_CUPID
-                    return
+        # most_common, votes = self.get_votes()
 
-            if self.phase <= self.STATE_NIGHT_CUPID:
-                if "cupid" in cards:
-                    cupid = self.get_player_with_card("cupid")
-                    players = self.get_votes(cupid, number_required=2)
+        cards = {role for role, players in self.roles.items() if players}
+        logger.info("Game %s finished phase %s, ticking.", self.display_name, self.phase)
+        if self.phase <= self.STATE_STARTED and self.first_night:
+            self.mayor, votes = self.get_votes()
+            self.emit("mayor", self.mayor.uuid)
+            logger.debug("%s now have %s as a mayor", self.display_name, self.mayor.display_name)
 
-                    for lover in players:
-                        lover.love = players
+            # self.mayor = self.get_player_with_uuid(most_common)
 
+            if "stealer" in cards:
                 self.need_to_complete_phase_before = current_time + 1 * MINUTE
-                self.get_votes()  # Reset votes
-                self.phase = self.STATE_NIGHT_WEREWOLVES
+                self.phase = self.STATE_NIGHT_STEALER
                 return
 
-            if self.phase <= self.STATE_NIGHT_WEREWOLVES:
-
-                most_common, votes = self.get_votes(count_only_werewolves=True)
-
-                self.players_alive.remove(most_common)
-                self.players_killed_last_night.add(most_common)
-
-                if "sorceress" in cards:
-                    self.need_to_complete_phase_before = current_time + 30
-                    self.phase = self.STATE_NIGHT_SORCERESS
-                    return
-
-            if self.phase <= self.STATE_NIGHT_SORCERESS:
-                self.need_to_complete_phase_before = current_time + 5 * MINUTE
-                self.first_night = False
+        if self.phase <= self.STATE_NIGHT_STEALER and self.first_night:
+            if "stealer" in cards:
+                stealer = self.get_player_with_card("stealer")
+                player_stolen = self.get_votes(player=stealer, number_required=1)[0]
+                stolen_card = player_stolen.cards[self]
+                self.set_card(player_stolen, stealer.cards[self])
+                self.set_card(stealer, stolen_card)
+                stealer.touch()
+                player_stolen.touch()
+
+            if "cupid" in cards:
+                self.need_to_complete_phase_before = current_time + 1 * MINUTE
                 self.get_votes()  # Reset votes
-                self.phase = self.STATE_DAY_VOTE
+                self.phase = self.STATE_NIGHT_CUPID
                 return
 
-            # Hunter state is set outside of TICK, in case the vote result kills the Hunter.
-            if self.phase <= self.STATE_DAY_HUNTER:
-                self.need_to_complete_phase_before = current_time + 1 * MINUTE
-                self.phase = self.STATE_NIGHT_WEREWOLVES
-                return
+        if self.phase <= self.STATE_NIGHT_CUPID:
+            if "cupid" in cards:
+                cupid = self.get_player_with_card("cupid")
+                players = self.get_votes(player=cupid, number_required=2)
 
-    def give_cards(self):
-        player_count = len(self.players)
+                for lover in players:
+                    lover.love = players
+                    lover.touch()
+                self.emit("lovers", [lover.uuid for lover in players])
 
-        if player_count < 3:
-            cards = ["werewolve"]
+            self.need_to_complete_phase_before = current_time + 1 * MINUTE
+            self.get_votes()  # Reset votes
+            self.phase = self.STATE_NIGHT_WEREWOLVES
+            return
 
-        elif player_count < 5:
-            cards = ["werewolve", "sorceress"]
+        if self.phase <= self.STATE_NIGHT_WEREWOLVES:
 
-        elif player_count <= 7:
-            cards = ["werewolve", "werewolve", "sorceress"]
+            most_common, votes = self.get_votes(count_only_werewolves=True)
 
-        elif player_count <= 9:
-            cards = ["werewolve", "werewolve", "sorceress", "stealer", "cupid"]
+            self.kill(most_common, last_night=True)
 
-        elif player_count <= 11:
-            cards = ["werewolve", "werewolve", "werewolve", "sorceress", "stealer", "cupid"]
+            if "sorceress" in cards:
+                self.need_to_complete_phase_before = current_time + 30
+                self.phase = self.STATE_NIGHT_SORCERESS
+                return
 
-        else:
-            cards = ["werewolve", "werewolve", "werewolve", "werewolve", "sorceress", "stealer", "cupid"]
+        if self.phase <= self.STATE_NIGHT_SORCERESS:
+            self.need_to_complete_phase_before = current_time + 5 * MINUTE
+            self.first_night = False
+            self.get_votes()  # Reset votes
+            self.phase = self.STATE_DAY_VOTE
+            return
 
-        while len(cards) < player_count:
-            cards.append("villager")
+        # Hunter state is set outside of TICK, in case the vote result kills the Hunter.
+        if self.phase <= self.STATE_DAY_HUNTER:
+            self.need_to_complete_phase_before = current_time + 1 * MINUTE
+            self.phase = self.STATE_NIGHT_WEREWOLVES
+            return
 
+    def give_cards(self):
+        cards = card_table(len(self.players))
         random.shuffle(cards)
 
-        logger.info(f"We are giving out cards for game {self.display_name} : {cards}")
+        logger.info("We are giving out cards for game %s : %s", self.display_name, cards)
 
         for player in self.players:
             carte = Card(player, cards.pop())
             player.cards[self] = carte
             self.cards.append(carte)
-
-            self.players_alive.add(player)
+            player.touch()
+        self.cards_changed()
 
     def start(self):
-        logger.info(f"Starting game {self.display_name}, with players {self.players}")
+        logger.info("Starting game %s, with players %s", self.display_name, self.players)
         if len(self.players) >= 2:
             self.phase = self.STATE_STARTED
             self.give_cards()
             self.need_to_complete_phase_before = int(time.time() + 1 * MINUTE)
-            self.players_alive = self.players
+            # Everyone is alive
+            self.set_roster("players_alive", self.players)
+            self.reindex()
+            self.emit("started", self.need_to_complete_phase_before, [(c.owner.uuid, c.name) for c in self.cards])
+            self.touch()
             return True
         else:
             return False
 
 
+def card_table(player_count):
+    """
+    The cards given out in a game of `player_count` players, not shuffled.
+    """
+    if player_count < 3:
+        cards = ["werewolve"]
+
+    elif player_count < 5:
+        cards = ["werewolve", "sorceress"]
+
+    elif player_count <= 7:
+        cards = ["werewolve", "werewolve", "sorceress"]
+
+    elif player_count <= 9:
+        cards = ["werewolve", "werewolve", "sorceress", "stealer", "cupid"]
+
+    elif player_count <= 11:
+        cards = ["werewolve", "werewolve", "werewolve", "sorceress", "stealer", "cupid"]
+
+    else:
+        cards = ["werewolve", "werewolve", "werewolve", "werewolve", "sorceress", "stealer", "cupid"]
+
+    while len(cards) < player_count:
+        cards.append("villager")
+
+    return cards
+
+
+class VoteTally:
+    """
+    Number of votes for each target, updated as the votes arrive. The leaders (the targets with the most votes, more
+    than one in case of a tie) are known at any time.
+    """
+    __slots__ = ("targets", "counts", "by_count", "max")
+
+    def __init__(self):
+        # Voter -> target
+        self.targets = {}
+        # Target -> number of votes
+        self.counts = {}
+        # Number of votes -> targets
+        self.by_count = {}
+        self.max = 0
+
+    def __len__(self):
+        return len(self.targets)
+
+    def _move(self, target, old_count, new_count):
+        if old_count:
+            targets = self.by_count[old_count]
+            targets.discard(target)
+            if not targets:
+                del self.by_count[old_count]
+        if new_count:
+            self.counts[target] = new_count
+            self.by_count.setdefault(new_count, set()).add(target)
+        else:
+            del self.counts[target]
+
+    def add(self, voter, target):
+        """
+        Count the vote of `voter` for `target`, replacing their previous vote.
+        """
+        if self.targets.get(voter) == target:
+            return
+        self.remove(voter)
+
+        self.targets[voter] = target
+        count = self.counts.get(target, 0) + 1
+        self._move(target, count - 1, count)
+        self.max = max(self.max, count)
+
+    def remove(self, voter):
+        target = self.targets.pop(voter, None)
+        if target is None:
+            return
+
+        count = self.counts[target]
+        self._move(target, count, count - 1)
+        # Counts only change by one, so the next best is just below
+        if count == self.max and count not in self.by_count:
+            self.max -= 1
+
+    def leaders(self):
+        return self.by_count.get(self.max, set())
+
+    def clear(self):
+        self.targets = {}
+        self.counts = {}
+        self.by_count = {}
+        self.max = 0
+
+
 class Player:
-    def __init__(self, name):
+    __slots__ = ("name", "uuid", "token", "games_created", "games", "current_game", "last_activity", "cards", "love",
+                 "history", "history_count", "created_count", "revision", "on_change")
+
+    def __init__(self, name, uuid=None):
         self.name = name
-        self.uuid = str(uuid4())
-        self.display_name = f"{self.name} §({self.uuid})"
+        self.uuid = uuid or str(uuid4())
         self.token = str(uuid4())
         self.games_created = set()
         self.games = set()
         self.current_game = None
         self.last_activity = int(time.time())
         self.cards = {}
-        self.love = {}
-
-    def public_dict(self):
+        # The lovers (this player included), if Cupid chose this player
+        self.love = None
+        # Archived games played (uuids, the last PLAYER_HISTORY_SIZE ones, oldest first), and how many were played and
+        # created in all. `games` and `games_created` only hold the games still in the cache.
+        self.history = ()
+        self.history_count = 0
+        self.created_count = 0
+        # Bumped on every change of the player profile
+        self.revision = 0
+        # Called with the player after each change, set by the cache storing the player.
+        self.on_change = None
+
+    @property
+    def display_name(self):
+        return f"{self.name} §({self.uuid})"
+
+    def touch(self):
+        self.revision += 1
+        if self.on_change:
+            self.on_change(self)
+
+    def etag(self, private=False, page=None):
+        """
+        Version tag of public_dict(), or private_dict() if `private` is True. `page` identifies the page of the games
+        history, if not the default one.
+        """
+        kind = "private" if private else "public"
+        if page:
+            kind += f"-{page}"
+        return f'"{self.uuid}-{self.revision}-{kind}"'
+
+    def forget_game(self, game):
+        """
+        Called when `game` is archived : it moves to the player history.
+        """
+        changed = False
+        if game in self.games:
+            self.games.discard(game)
+            self.history = self.history[-(PLAYER_HISTORY_SIZE - 1):] + (game.uuid,)
+            self.history_count += 1
+            changed = True
+        if game in self.games_created:
+            self.games_created.discard(game)
+            self.created_count += 1
+            changed = True
+        if self.cards.pop(game, None) is not None:
+            changed = True
+        if self.current_game is game:
+            self.current_game = None
+            changed = True
+
+        if changed:
+            self.touch()
+
+    def game_history(self, offset=0, limit=HISTORY_PAGE):
+        """
+        Uuids of the games played, most recent first : the games in the cache, then the archived ones.
+        """
+        current = [g.uuid for g in sorted(self.games, key=lambda g: g.created_at, reverse=True)]
+        archived = self.history[::-1]
+        return (current + list(archived))[offset:offset + limit]
+
+    def public_dict(self, games_offset=0, games_limit=HISTORY_PAGE):
+        """
+        Only a page of the games played is given, see game_history(). games_count and games_created_count include the
+        archived games.
+        """
         return {
-            "games": [g.uuid for g in self.games],
+            "games": self.game_history(games_offset, games_limit),
+            "games_count": len(self.games) + self.history_count,
             "games_created": [g.uuid for g in self.games_created],
+            "games_created_count": len(self.games_created) + self.created_count,
             "name": self.name,
-            "uuid": self.uuid
+            "uuid": self.uuid,
+            "revision": self.revision
         }
 
-    def private_dict(self):
-        res = self.public_dict()
+    def private_dict(self, games_offset=0, games_limit=HISTORY_PAGE):
+        res = self.public_dict(games_offset, games_limit)
         cards = {}
         for game in self.cards.keys():
             cards[game.uuid] = self.cards[game].name
 
         res["cards"] = cards
         res["current_game"] = self.current_game.uuid if self.current_game else None
-        res["love"] = self.love
+        res["love"] = [p.uuid for p in self.love] if self.love else []
         return res
 
 
 class Card:
+    __slots__ = ("name", "owner", "heal_potion", "kill_potion")
+
     def __init__(self, owner, name):
-        self.name = name
+        # Role names are shared by all the cards, rather than a string per card
+        self.name = sys.intern(name)
         self.owner = owner
         self.heal_potion = (name == "sorceress")
         self.kill_potion = (name == "sorceress")
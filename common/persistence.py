@@ -0,0 +1,465 @@
+#!/usr/bin/env python3.6
+# -*- coding:Utf-8 -*-
+"""
+Persistence of a cache.Cache on disk, with snapshots and a write-ahead log.
+
+    - The snapshot is a compact copy of every player and game. It is written by a forked child process (when the
+      platform allows it), so the server keeps handling requests while it is written.
+    - Between snapshots, every change of a player or a game is appended to the log, as the new record of the object
+      (or its removal). Records are idempotent, so replaying a record that is already in the snapshot is harmless.
+
+On startup, the latest snapshot is loaded and the logs written after it are replayed : for each object, only its last
+record is kept, and objects are only built once.
+
+The records are also used by common.storage to share the state between processes.
+"""
+import logging
+import os
+import pickle
+import sys
+import threading
+
+import time
+
+from common import objects
+
+try:
+    import fcntl
+except ImportError:
+    # Windows : the data directory isn't locked
+    fcntl = None
+
+logger = logging.getLogger("werewolves")
+
+SNAPSHOT_INTERVAL = 5 * 60
+SNAPSHOT_MIN_LOG_SIZE = 1024 * 1024
+FSYNC_INTERVAL = 1
+
+SNAPSHOT_FILE = "snapshot.pickle"
+LOG_PREFIX = "wal."
+LOCK_FILE = "lock"
+
+
+## RECORDS ##
+
+
+def dump_player(player: objects.Player):
+    cards = {}
+    for game, card in player.cards.items():
+        # Cards are saved as their index in the game cards, so they are the same objects once loaded
+        for index, game_card in enumerate(game.cards):
+            if game_card is card:
+                cards[game.uuid] = index
+                break
+        else:
+            logger.warning("Card %s of %s isn't in game %s, not saving it.", card, player.display_name,
+                           game.display_name)
+
+    love = [p.uuid for p in player.love] if player.love else None
+
+    return ("player", player.uuid, player.name, player.token, player.last_activity, player.revision,
+            [g.uuid for g in player.games_created], [g.uuid for g in player.games],
+            player.current_game.uuid if player.current_game else None, cards, love, player.history,
+            player.history_count, player.created_count)
+
+
+def dump_game(game: objects.Game):
+    # Once started, players_alive is the players set itself.
+    alive = None if game.players_alive is game.players else [p.uuid for p in game.players_alive]
+
+    return ("game", game.uuid, game.name, game.owner.uuid, game.created_at, game.phase, game.first_night,
+            game.need_to_complete_phase_before, game.mayor.uuid if game.mayor else None, game.pristress_last_used,
+            game.revision, [p.uuid for p in game.players], alive, [p.uuid for p in game.players_killed_last_night],
+            {p.uuid: list(v) for p, v in game.votes.items()},
+            [(c.owner.uuid, c.name, c.heal_potion, c.kill_potion) for c in game.cards])
+
+
+def load_cards(game, cards, get_player):
+    """
+    Set the cards of `game` from their records. The players outside of the records being applied still reference the
+    cards of the game : the cards are updated in place, and if there are new ones, these players are given the new
+    card at the index of their old one.
+    """
+    if len(game.cards) == len(cards):
+        for card, (card_owner, card_name, heal_potion, kill_potion) in zip(game.cards, cards):
+            card.owner = get_player(card_owner) or card.owner
+            if card.name != card_name:
+                card.name = sys.intern(card_name)
+                game.cards_changed()
+            card.heal_potion = heal_potion
+            card.kill_potion = kill_potion
+        return
+
+    game.cards_changed()
+    old_cards = {id(card): index for index, card in enumerate(game.cards)}
+    game.cards = []
+    for card_owner, card_name, heal_potion, kill_potion in cards:
+        card = objects.Card(get_player(card_owner), card_name)
+        card.heal_potion = heal_potion
+        card.kill_potion = kill_potion
+        game.cards.append(card)
+
+    for player in game.players | {card.owner for card in game.cards if card.owner}:
+        index = old_cards.get(id(player.cards.get(game)))
+        if index is not None:
+            if index < len(game.cards):
+                player.cards[game] = game.cards[index]
+            else:
+                del player.cards[game]
+
+
+def apply_records(records, cache):
+    """
+    Create or update players and games from their records, link them and store them in the cache.
+    Objects already in the cache are updated in place, as other objects reference them.
+
+    `records` is a dict with, for "player" and "game", a dict of records indexed by uuid. A None record means the
+    object was removed. Unknown uuids (objects removed since) are left out.
+    """
+    players = {}
+    games = {}
+    new_players = []
+    new_games = []
+
+    for uuid, record in records["player"].items():
+        player = cache.get_player_by_uuid(uuid)
+        if record is None:
+            if player:
+                cache.remove_player(player)
+            continue
+
+        _, uuid, name, token, last_activity, revision = record[:6]
+        if not player:
+            player = objects.Player(name, uuid)
+            player.token = token
+            new_players.append(player)
+        player.last_activity = last_activity
+        player.revision = revision
+        players[uuid] = player
+
+    def get_player(uuid):
+        return players.get(uuid) or cache.get_player_by_uuid(uuid)
+
+    for uuid, record in records["game"].items():
+        game = cache.get_game_by_uuid(uuid)
+        if record is None:
+            if game:
+                cache.remove_game(game)
+            continue
+
+        (_, uuid, name, owner, created_at, phase, first_night, deadline, mayor, pristress_last_used, revision,
+         players_uuid, alive, killed, votes, cards) = record
+        owner = get_player(owner)
+        if not owner:
+            # The owner was removed (eg. expired) while the game went on : like Cache.expire, give it to the player
+            # with the smallest uuid, so every process picks the same one.
+            players_found = sorted((p for p in map(get_player, players_uuid) if p), key=lambda p: p.uuid)
+            if not players_found:
+                continue
+            owner = players_found[0]
+
+        if not game:
+            game = objects.Game(name, owner, uuid)
+            game.created_at = created_at
+            # Loaded, not created : its events were saved by the process that made them
+            game.events.clear()
+            new_games.append(game)
+
+        with game.changed:
+            if game.owner is not owner:
+                cache.change_owner(game, owner, save=False)
+            game.phase = phase
+            game.first_night = first_night
+            game.need_to_complete_phase_before = deadline
+            game.mayor = get_player(mayor)
+            game.pristress_last_used = pristress_last_used
+            game.set_roster("players", {get_player(p) for p in players_uuid if get_player(p)})
+            if alive is None:
+                game.set_roster("players_alive", game.players)
+            else:
+                game.set_roster("players_alive", {get_player(p) for p in alive if get_player(p)})
+            game.set_roster("players_killed_last_night", {get_player(p) for p in killed if get_player(p)})
+            game.votes = {get_player(p): set(v) for p, v in votes.items() if get_player(p)}
+
+            load_cards(game, cards, get_player)
+
+            if game.revision != revision:
+                base_revision = game.revision
+                game.revision = revision
+                game.log_change(base_revision)
+        games[uuid] = game
+
+    def get_game(uuid):
+        return games.get(uuid) or cache.get_game_by_uuid(uuid)
+
+    for uuid, player in players.items():
+        (_, uuid, name, token, last_activity, revision, games_created, games_played, current_game, cards,
+         love) = records["player"][uuid][:11]
+        # Records written before the archive don't have the history
+        player.history, player.history_count, player.created_count = records["player"][uuid][11:] or ((), 0, 0)
+        player.games_created = {get_game(g) for g in games_created if get_game(g)}
+        player.games = {get_game(g) for g in games_played if get_game(g)}
+        player.current_game = get_game(current_game)
+
+        player.cards = {}
+        for game_uuid, card in cards.items():
+            game = get_game(game_uuid)
+            if game and isinstance(card, int) and card < len(game.cards):
+                player.cards[game] = game.cards[card]
+
+        player.love = [get_player(p) for p in love if get_player(p)] if love else None
+
+    # The indexes depend on the cards of the players, that may have changed without their game
+    changed_games = set(games.values())
+    for player in players.values():
+        changed_games.update(player.cards.keys())
+    for game in changed_games:
+        with game.changed:
+            game.reindex()
+
+    for player in new_players:
+        cache.add_player(player)
+    for player in players.values():
+        cache.index_player(player)
+
+    for game in new_games:
+        cache.add_game(game)
+    for game in games.values():
+        cache.reindex_game(game)
+
+
+## JOURNAL ##
+
+
+class Journal:
+    """
+    Saves every change of a cache to `path`. See the module docstring.
+
+    Usage :
+        journal = Journal(cache, path)
+        journal.open()  # Load the saved state in the cache, and start logging its changes
+        journal.start()  # Start the background thread taking snapshots
+    """
+
+    def __init__(self, cache, path, snapshot_interval=SNAPSHOT_INTERVAL):
+        self.cache = cache
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+
+        self.lock = threading.Lock()
+        self.log_file = None
+        self.lock_file = None
+        self.log_generation = 0
+        self.snapshot_pid = None
+        self.snapshot_generation = None
+        self.thread = None
+        self.running = False
+
+    def _log_path(self, generation):
+        return os.path.join(self.path, f"{LOG_PREFIX}{generation:08d}")
+
+    def _log_generations(self):
+        return sorted(int(f[len(LOG_PREFIX):]) for f in os.listdir(self.path) if f.startswith(LOG_PREFIX))
+
+    ## LOADING ##
+
+    def _lock(self):
+        """
+        Only one process may save to a directory : take an exclusive lock on it, or fail right away.
+        """
+        if fcntl is None:
+            return
+
+        self.lock_file = open(os.path.join(self.path, LOCK_FILE), "w")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            self.lock_file = None
+            raise RuntimeError(f"{self.path} is used by another process. Each process (or shard) needs its own "
+                               f"data directory, or the processes must share their state in SQLite.")
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._lock()
+        time_start = time.time()
+
+        records = {"player": {}, "game": {}}
+        first_generation = 0
+        records_count = 0
+
+        snapshot_path = os.path.join(self.path, SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, "rb") as f:
+                snapshot = pickle.load(f)
+            first_generation = snapshot["generation"]
+            for record in snapshot["records"]:
+                records[record[0]][record[1]] = record
+            records_count += len(snapshot["records"])
+
+        generations = [g for g in self._log_generations() if g >= first_generation]
+        for generation in generations:
+            records_count += self._replay(self._log_path(generation), records)
+
+        apply_records(records, self.cache)
+
+        self.log_generation = max(generations + [first_generation]) + 1
+        self.log_file = open(self._log_path(self.log_generation), "ab")
+        self.cache.journal = self
+
+        time_taken = round(time.time() - time_start, 3)
+        logger.info("Loaded %s players and %s games from %s records in %s seconds.", len(self.cache.players),
+                    len(self.cache.games), records_count, time_taken)
+
+    @staticmethod
+    def _replay(log_path, records):
+        count = 0
+        with open(log_path, "rb") as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, AttributeError, IndexError):
+                    # The server was stopped in the middle of a write, the rest of this log is lost.
+                    logger.warning("Truncated record in %s, ignoring the end of the file.", log_path)
+                    break
+
+                kind, uuid = record[0], record[1]
+                if kind == "del_player":
+                    records["player"][uuid] = None
+                elif kind == "del_game":
+                    records["game"][uuid] = None
+                else:
+                    records[kind][uuid] = record
+                count += 1
+        return count
+
+    ## LOGGING ##
+
+    def _write(self, record):
+        with self.lock:
+            if self.log_file:
+                pickle.dump(record, self.log_file, pickle.HIGHEST_PROTOCOL)
+                self.log_file.flush()
+
+    def player_changed(self, player):
+        self._write(dump_player(player))
+
+    def player_removed(self, player):
+        self._write(("del_player", player.uuid))
+
+    def game_changed(self, game):
+        self._write(dump_game(game))
+
+    def game_removed(self, game):
+        self._write(("del_game", game.uuid))
+
+    ## SNAPSHOTS ##
+
+    def snapshot(self):
+        """
+        Start a new log, and write a snapshot of the cache that replaces the previous logs.
+
+        When os.fork is available, the snapshot is written by a child process, working on a copy-on-write image of
+        the memory. Otherwise, it is written by the calling thread.
+        """
+        if self.snapshot_pid:
+            return
+
+        with self.lock:
+            self.log_file.close()
+            self.log_generation += 1
+            self.log_file = open(self._log_path(self.log_generation), "ab")
+            generation = self.log_generation
+
+            if hasattr(os, "fork"):
+                pid = os.fork()
+                if pid == 0:
+                    # Child : no logging here, the logging locks may be held by another thread of the parent.
+                    code = 0
+                    try:
+                        self._write_snapshot(generation)
+                    except BaseException:
+                        code = 1
+                    os._exit(code)
+
+                self.snapshot_pid = pid
+                self.snapshot_generation = generation
+                return
+
+        self._write_snapshot(generation)
+        self._snapshot_done(generation)
+
+    def _write_snapshot(self, generation):
+        records = [dump_player(p) for p in list(self.cache.players)]
+        records += [dump_game(g) for g in list(self.cache.games)]
+
+        tmp_path = os.path.join(self.path, SNAPSHOT_FILE + ".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"generation": generation, "records": records}, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.path, SNAPSHOT_FILE))
+
+    def _snapshot_done(self, generation):
+        for old_generation in self._log_generations():
+            if old_generation < generation:
+                os.remove(self._log_path(old_generation))
+        logger.info("Snapshot done, now logging to generation %s.", generation)
+
+    def _check_snapshot(self):
+        if not self.snapshot_pid:
+            return
+
+        pid, status = os.waitpid(self.snapshot_pid, os.WNOHANG)
+        if pid == 0:
+            return
+
+        if status == 0:
+            self._snapshot_done(self.snapshot_generation)
+        else:
+            logger.error("Snapshot process failed with status %s, keeping the logs.", status)
+        self.snapshot_pid = None
+
+    ## BACKGROUND THREAD ##
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="journal", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        last_snapshot = time.time()
+        while self.running:
+            time.sleep(FSYNC_INTERVAL)
+
+            with self.lock:
+                if self.log_file:
+                    os.fsync(self.log_file.fileno())
+
+            self._check_snapshot()
+
+            if time.time() - last_snapshot >= self.snapshot_interval:
+                if self.log_file.tell() >= SNAPSHOT_MIN_LOG_SIZE:
+                    self.snapshot()
+                last_snapshot = time.time()
+
+    def close(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+        while self.snapshot_pid:
+            self._check_snapshot()
+            time.sleep(0.01)
+
+        with self.lock:
+            if self.log_file:
+                self.log_file.close()
+                self.log_file = None
+        self.cache.journal = None
+
+        if self.lock_file:
+            self.lock_file.close()
+            self.lock_file = None
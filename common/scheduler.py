@@ -0,0 +1,149 @@
+#!/usr/bin/env python3.6
+# -*- coding:Utf-8 -*-
+"""
+Background scheduler advancing the games to their next phase (see Game.tick), when the phase deadline passes or when
+every vote needed is in. Clients only read the games. Finished games are archived ARCHIVE_DELAY after they finish.
+
+The deadlines of all the games are kept in a priority queue. The cache tells the scheduler about every change of a
+game (see Cache.reindex_game), so a game whose votes are all in is scheduled right away.
+"""
+import heapq
+import logging
+import threading
+
+import time
+
+logger = logging.getLogger("werewolves")
+
+# Longest sleep of the scheduler thread, so it notices when it is stopped.
+MAX_SLEEP = 1
+# Finished games stay in the cache for that long, so the players see the end of the game.
+ARCHIVE_DELAY = 10 * 60
+EXPIRE_INTERVAL = 1
+
+
+class PhaseScheduler:
+    """
+    Usage :
+        scheduler = PhaseScheduler(cache)  # Before loading the games in the cache, so they are scheduled
+        scheduler.start()
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.condition = threading.Condition()
+        # Min-heap of (time, game uuid). May contain entries that were since replaced by an earlier one.
+        self.heap = []
+        # Game uuid -> time it is scheduled at
+        self.scheduled = {}
+        # Uuids of the finished games, scheduled to be archived
+        self.finished = set()
+        self.thread = None
+        self.running = False
+
+        cache.scheduler = self
+
+    def schedule(self, game, when, replace=False):
+        """
+        Schedule the game at `when`, unless it is already scheduled earlier and `replace` is False.
+        """
+        with self.condition:
+            if self.scheduled.get(game.uuid, when + 1) <= when and not replace:
+                return
+            self.scheduled[game.uuid] = when
+            heapq.heappush(self.heap, (when, game.uuid))
+            if self.heap[0][1] == game.uuid:
+                self.condition.notify()
+
+    def game_changed(self, game):
+        if game.phase == game.STATE_NOT_STARTED:
+            return
+
+        if game.phase == game.STATE_FINISHED:
+            # Replaces the deadline of the last phase, but isn't pushed back by later changes
+            with self.condition:
+                if game.uuid in self.finished:
+                    return
+                self.finished.add(game.uuid)
+            self.schedule(game, time.time() + ARCHIVE_DELAY, replace=True)
+            return
+
+        if game.should_tick():
+            self.schedule(game, time.time())
+        else:
+            # Deadlines are compared to the time in whole seconds
+            self.schedule(game, game.need_to_complete_phase_before + 1)
+
+    def _next_due(self):
+        """
+        Wait for the next game to tick, and return its uuid, or None if stopped.
+        """
+        with self.condition:
+            while self.running:
+                now = time.time()
+                if self.heap and self.heap[0][0] <= now:
+                    when, uuid = heapq.heappop(self.heap)
+                    if self.scheduled.get(uuid) != when:
+                        continue
+                    del self.scheduled[uuid]
+                    return uuid
+
+                timeout = min(self.heap[0][0] - now, MAX_SLEEP) if self.heap else MAX_SLEEP
+                self.condition.wait(timeout)
+
+    def tick(self, uuid):
+        game = self.cache.get_game_by_uuid(uuid)
+        if not game:
+            self.finished.discard(uuid)
+            return
+
+        with self.cache.transaction():
+            # The game may have changed since it was scheduled, eg. in another worker. tick() checks it again.
+            if game.phase == game.STATE_FINISHED:
+                if self.cache.get_game_by_uuid(uuid):
+                    self.cache.archive_game(game)
+                    logger.info("Archived game %s.", game.display_name)
+                self.finished.discard(uuid)
+                return
+            game.tick()
+
+        # If nothing changed, the game isn't rescheduled by the cache.
+        if game.uuid not in self.scheduled:
+            self.game_changed(game)
+
+    def expire(self):
+        with self.cache.transaction():
+            self.cache.expire()
+
+    ## BACKGROUND THREAD ##
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        last_expire = time.time()
+        while self.running:
+            if time.time() - last_expire >= EXPIRE_INTERVAL:
+                try:
+                    self.expire()
+                except Exception:
+                    logger.exception("Couldn't expire the inactive players.")
+                last_expire = time.time()
+
+            uuid = self._next_due()
+            if uuid is None:
+                continue
+            try:
+                self.tick(uuid)
+            except Exception:
+                logger.exception("Couldn't tick game %s.", uuid)
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+        self.cache.scheduler = None
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3.6
+# -*- coding:Utf-8 -*-
+"""
+Game-affinity sharding : each game (and each player, for player-scoped calls) is owned by one of N server processes,
+chosen from its uuid. The router (server/router.py) forwards every call to the owning shard.
+"""
+import zlib
+from uuid import uuid4
+
+
+def shard_of(uuid, shard_count):
+    # crc32 rather than hash(), that changes from one process to another
+    return zlib.crc32(uuid.encode()) % shard_count
+
+
+def parse_shard(spec):
+    """
+    Parse a "index/count" shard specification, eg. "0/4" for the first of 4 shards.
+    """
+    index, count = (int(x) for x in spec.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard {spec}")
+    return index, count
+
+
+def owned_uuid(shard_index, shard_count):
+    """
+    Generate a new uuid owned by the given shard. It takes shard_count tries on average.
+    """
+    while True:
+        uuid = str(uuid4())
+        if shard_of(uuid, shard_count) == shard_index:
+            return uuid
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3.6
+# -*- coding:Utf-8 -*-
+"""
+Monte Carlo simulation of the games, to find how often each side wins with the cards given out by Game.give_cards.
+
+Many games are played at once with NumPy : each array holds one row per game and one column per player (roles, alive
+players, votes). The rules are the ones of Game._tick :
+    - the stealer swaps their card with another player on the first night (Cupid's lovers have no effect in the rules)
+    - each night, the werewolves vote, and the player with the most votes is killed (a random player if no werewolf is
+      left to vote)
+    - the sorceress, if alive at nightfall, may save the victim and poison someone, once each per game
+    - the day vote kills nobody, unless `lynch` is set
+    - the game is finished when at most one player is alive.
+The werewolves win if one of them is among the survivors, the village wins if someone else is, and nobody wins if
+everyone died.
+
+The players vote at random (the werewolves only for the other players). Batches of games are spread over a pool of
+processes. From the root of the repository (needs numpy) :
+
+    python3 -m common.simulation                          # 1 million games for each player count, from 2 to 18
+    python3 -m common.simulation --games 100000 --players 8,12 --lynch
+    python3 -m common.simulation --table 8=werewolve,werewolve,sorceress --players 8
+"""
+import argparse
+import json
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from common.objects import card_table
+
+ROLES = ("villager", "werewolve", "sorceress", "stealer", "cupid")
+VILLAGER, WEREWOLF, SORCERESS, STEALER, CUPID = range(len(ROLES))
+OUTCOMES = ("werewolves", "village", "nobody")
+
+# Games simulated together by a process
+BATCH_SIZE = 50000
+# Chance the sorceress uses her potions, when she still has them
+HEAL_PROBABILITY = 0.5
+POISON_PROBABILITY = 0.2
+
+
+## SIMULATION ##
+
+
+def pick(rng, mask):
+    """
+    A column chosen uniformly among the True ones of each row of `mask`, -1 for the rows without any.
+    """
+    keys = rng.random(mask.shape)
+    keys[~mask] = -1
+    chosen = keys.argmax(axis=1)
+    chosen[~mask.any(axis=1)] = -1
+    return chosen
+
+
+def tally(rng, voters, targets, counts=None):
+    """
+    Each voter of each game votes for one of the targets at random. Returns the number of votes for each column, added
+    to `counts` if given.
+    """
+    games, players = voters.shape
+    rows = np.arange(games)
+    if counts is None:
+        counts = np.zeros((games, players))
+    voter_counts = voters.sum(axis=1)
+
+    for k in range(voter_counts.max(initial=0)):
+        choice = pick(rng, targets)
+        voting = (voter_counts > k) & (choice >= 0)
+        counts[rows[voting], choice[voting]] += 1
+    return counts
+
+
+def leader(rng, counts):
+    """
+    The column with the most votes in each game, ties broken at random, -1 in the games without votes.
+    """
+    voted = counts.max(axis=1) > 0
+    # Less than a vote of noise, so it only breaks ties
+    result = (counts + rng.random(counts.shape) * 0.5 * (counts > 0)).argmax(axis=1)
+    result[~voted] = -1
+    return result
+
+
+def simulate(cards, games, seed=None, heal=HEAL_PROBABILITY, poison=POISON_PROBABILITY, lynch=False):
+    """
+    Play `games` games with the given cards (one per player). Returns the number of games won by each side (see
+    OUTCOMES), and the total number of nights played.
+    """
+    rng = np.random.default_rng(seed)
+    players = len(cards)
+    rows = np.arange(games)
+    deck = np.array([ROLES.index(card) for card in cards], dtype=np.int8)
+
+    # A shuffled deck per game
+    roles = deck[rng.random((games, players)).argsort(axis=1)]
+    alive = np.ones((games, players), dtype=bool)
+    heal_potion = np.ones(games, dtype=bool)
+    kill_potion = np.ones(games, dtype=bool)
+    nights = np.zeros(games, dtype=np.int64)
+
+    if STEALER in deck:
+        stealer = (roles == STEALER).argmax(axis=1)
+        stolen = (stealer + rng.integers(1, players, games)) % players
+        roles[rows, stealer] = roles[rows, stolen]
+        roles[rows, stolen] = STEALER
+
+    def kill(running, victims):
+        killed = running & (victims >= 0)
+        alive[rows[killed], victims[killed]] = False
+
+    finished = alive.sum(axis=1) <= 1
+    # A player at least dies every night, but the one saved by the sorceress
+    for _ in range(players + 1):
+        running = ~finished
+        if not running.any():
+            break
+        nights += running
+
+        # Werewolves
+        wolves = alive & (roles == WEREWOLF)
+        prey = alive & (roles != WEREWOLF)
+        victims = leader(rng, tally(rng, wolves, np.where(prey.any(axis=1, keepdims=True), prey, alive)))
+        unvoted = victims < 0
+        victims[unvoted] = pick(rng, alive[unvoted])
+        sorceress_alive = (alive & (roles == SORCERESS)).any(axis=1)
+        kill(running, victims)
+
+        # Sorceress
+        healing = running & (victims >= 0) & sorceress_alive & heal_potion & (rng.random(games) < heal)
+        alive[rows[healing], victims[healing]] = True
+        heal_potion &= ~healing
+
+        poisoning = running & sorceress_alive & kill_potion & (rng.random(games) < poison)
+        kill(poisoning, pick(rng, alive & (roles != SORCERESS)))
+        kill_potion &= ~poisoning
+
+        finished |= alive.sum(axis=1) <= 1
+
+        # Day vote
+        if lynch:
+            running = ~finished
+            wolves = alive & (roles == WEREWOLF)
+            village = alive & ~wolves
+            # The werewolves vote against the village, the others at random
+            counts = tally(rng, village, alive)
+            tally(rng, wolves, np.where(village.any(axis=1, keepdims=True), village, alive), counts)
+            lynched = leader(rng, counts)
+            kill(running, lynched)
+            finished |= alive.sum(axis=1) <= 1
+
+    wolves_alive = (alive & (roles == WEREWOLF)).any(axis=1)
+    anyone_alive = alive.any(axis=1)
+    return {
+        "werewolves": int(wolves_alive.sum()),
+        "village": int((anyone_alive & ~wolves_alive).sum()),
+        "nobody": int((~anyone_alive).sum()),
+        "nights": int(nights.sum()),
+    }
+
+
+## PROCESS POOL ##
+
+
+def run(tables, games, seed=None, workers=None, batch_size=BATCH_SIZE, **rules):
+    """
+    Simulate `games` games for each table of cards (a list of card names per player count) over a pool of `workers`
+    processes. Returns a dict player count -> results of simulate() for all the batches, with the cards and the
+    number of games.
+    """
+    jobs = []
+    for player_count, cards in sorted(tables.items()):
+        for start in range(0, games, batch_size):
+            jobs.append((player_count, cards, min(batch_size, games - start)))
+
+    seeds = np.random.SeedSequence(seed).spawn(len(jobs))
+    results = {player_count: {"cards": cards, "games": 0, "nights": 0, **{outcome: 0 for outcome in OUTCOMES}}
+               for player_count, cards in tables.items()}
+
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [(player_count, size, pool.submit(simulate, cards, size, job_seed, **rules))
+                   for (player_count, cards, size), job_seed in zip(jobs, seeds)]
+        for player_count, size, future in futures:
+            result = results[player_count]
+            result["games"] += size
+            for key, value in future.result().items():
+                result[key] += value
+
+    return results
+
+
+def describe(cards):
+    return ", ".join(f"{cards.count(card)} {card}" for card in ROLES if card in cards)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Win rates of the werewolves for each number of players")
+    parser.add_argument("--games", type=int, default=1000000, help="Games simulated for each number of players")
+    parser.add_argument("--players", default="2-18", help="Numbers of players, like 8,12 or 2-18")
+    parser.add_argument("--table", action="append", default=[],
+                        help="Cards for a number of players instead of those of the game, like "
+                             "8=werewolve,werewolve,sorceress (completed with villagers)")
+    parser.add_argument("--lynch", action="store_true", help="The day vote kills the player with the most votes")
+    parser.add_argument("--heal", type=float, default=HEAL_PROBABILITY, help="Chance the sorceress saves the victim")
+    parser.add_argument("--poison", type=float, default=POISON_PROBABILITY, help="Chance the sorceress poisons someone")
+    parser.add_argument("--workers", type=int, help="Number of processes, the number of CPUs by default")
+    parser.add_argument("--seed", type=int, help="Seed, to get the same results again")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    if "-" in args.players:
+        first, last = args.players.split("-")
+        player_counts = range(int(first), int(last) + 1)
+    else:
+        player_counts = [int(count) for count in args.players.split(",")]
+
+    tables = {count: card_table(count) for count in player_counts}
+    for table in args.table:
+        count, cards = table.split("=")
+        cards = cards.split(",")
+        tables[int(count)] = cards + ["villager"] * (int(count) - len(cards))
+
+    results = run(tables, args.games, seed=args.seed, workers=args.workers, heal=args.heal, poison=args.poison,
+                  lynch=args.lynch)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    print(f"{'players':>7} {'werewolves':>10} {'village':>8} {'nobody':>7} {'nights':>6}  cards")
+    for player_count, result in sorted(results.items()):
+        rates = [result[outcome] / result["games"] * 100 for outcome in OUTCOMES]
+        print(f"{player_count:>7} {rates[0]:>9.1f}% {rates[1]:>7.1f}% {rates[2]:>6.1f}% "
+              f"{result['nights'] / result['games']:>6.2f}  {describe(result['cards'])}")
+
+
+if __name__ == '__main__':
+    main()
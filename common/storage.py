@@ -0,0 +1,237 @@
+#!/usr/bin/env python3.6
+# -*- coding:Utf-8 -*-
+"""
+Shared storage of a cache.Cache in SQLite, so that many worker processes (eg. gunicorn workers) on the same machine
+see the same players and games.
+
+Every worker keeps a full copy of the state in its cache, used for reads. The database holds the latest record of
+each object (see common.persistence for the records), and a `changes` table listing which objects changed, in order.
+A worker catches up by applying the objects changed since the last change it saw : this is a single indexed query
+when nothing changed, done at the beginning of each request and every SYNC_INTERVAL by a background thread.
+
+Changes are made in transactions (see Cache.transaction) : the write lock of the database is taken, the worker
+catches up, then the game is changed and its new records written. This serializes ticks, votes and joins on a game
+across all workers.
+
+Changes of different games are serialized too : the database has a single writer, so a lock per game wouldn't let
+them run at the same time. A vote holds the lock for about 0.1 ms, so all the workers together make about 10000 changes
+per second, however many there are. Beyond that, the games must be split between shards (see server/router.py), each
+with its own database.
+"""
+import logging
+import pickle
+import sqlite3
+import threading
+
+import time
+
+from contextlib import contextmanager
+
+from common import persistence
+
+logger = logging.getLogger("werewolves")
+
+SYNC_INTERVAL = 0.2
+PRUNE_INTERVAL = 60
+# Changes older than that are forgotten. Workers that are late by more than that reload everything.
+CHANGES_KEPT = 100000
+
+
+class SQLiteStorage:
+    """
+    Usage :
+        storage = SQLiteStorage(cache, path)
+        storage.open()  # Load the state in the cache, and start saving its changes
+        storage.start()  # Start the background thread syncing with the other workers
+    """
+
+    def __init__(self, cache, path, sync_interval=SYNC_INTERVAL):
+        self.cache = cache
+        self.path = path
+        self.sync_interval = sync_interval
+
+        self.lock = threading.RLock()
+        self.db = None
+        self.last_seq = 0
+        self.depth = 0
+        # Set while applying changes from the database, so they aren't written back.
+        self.applying = False
+        self.thread = None
+        self.running = False
+
+    def open(self):
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS players (uuid TEXT PRIMARY KEY, record BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS games (uuid TEXT PRIMARY KEY, record BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, uuid TEXT)")
+
+        self.reload()
+
+        self.cache.journal = self
+        self.cache.storage = self
+
+    ## READING ##
+
+    def reload(self):
+        """
+        Load the whole state from the database.
+        """
+        time_start = time.time()
+        with self.lock:
+            # Read everything in one transaction, unless we are already in one
+            own_transaction = not self.db.in_transaction
+            if own_transaction:
+                self.db.execute("BEGIN")
+            try:
+                self.last_seq = self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+                records = {
+                    "player": {uuid: pickle.loads(r) for uuid, r in self.db.execute("SELECT uuid, record FROM players")},
+                    "game": {uuid: pickle.loads(r) for uuid, r in self.db.execute("SELECT uuid, record FROM games")},
+                }
+            finally:
+                if own_transaction:
+                    self.db.execute("COMMIT")
+
+            # Objects that were removed by others while we weren't following
+            for player in list(self.cache.players):
+                records["player"].setdefault(player.uuid, None)
+            for game in list(self.cache.games):
+                records["game"].setdefault(game.uuid, None)
+
+            self._apply(records)
+
+        time_taken = round(time.time() - time_start, 3)
+        logger.info("Loaded %s players and %s games in %s seconds.", len(self.cache.players), len(self.cache.games),
+                    time_taken)
+
+    def sync(self):
+        """
+        Apply the changes made by the other workers since the last sync.
+        """
+        with self.lock:
+            changes = self.db.execute("SELECT seq, kind, uuid FROM changes WHERE seq > ? ORDER BY seq",
+                                      (self.last_seq,)).fetchall()
+            if not changes:
+                return
+
+            if changes[0][0] > self.last_seq + 1:
+                first_seq = self.db.execute("SELECT MIN(seq) FROM changes").fetchone()[0]
+                if first_seq > self.last_seq + 1:
+                    logger.warning("Changes since %s were forgotten, reloading everything.", self.last_seq)
+                    self.reload()
+                    return
+
+            records = {"player": {}, "game": {}}
+            for seq, kind, uuid in changes:
+                records[kind][uuid] = None
+
+            for kind, table in (("player", "players"), ("game", "games")):
+                uuids = list(records[kind].keys())
+                # SQLite limits the number of parameters of a query
+                for i in range(0, len(uuids), 500):
+                    chunk = uuids[i:i + 500]
+                    query = f"SELECT uuid, record FROM {table} WHERE uuid IN ({','.join('?' * len(chunk))})"
+                    for uuid, record in self.db.execute(query, chunk):
+                        records[kind][uuid] = pickle.loads(record)
+
+            self.last_seq = changes[-1][0]
+            self._apply(records)
+
+    def _apply(self, records):
+        self.applying = True
+        try:
+            # Readers of the cache must not see a half applied change
+            with self.cache.lock:
+                persistence.apply_records(records, self.cache)
+        finally:
+            self.applying = False
+
+    ## WRITING ##
+
+    @contextmanager
+    def transaction(self):
+        """
+        Take the write lock of the database and catch up with the other workers. Everything written until the end of
+        the block is committed at once. Changes written before an exception are kept, as they are in memory.
+        """
+        with self.lock:
+            if self.depth == 0:
+                self.db.execute("BEGIN IMMEDIATE")
+                self.sync()
+
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.db.execute("COMMIT")
+
+    def _write(self, kind, uuid, record):
+        if self.applying:
+            return
+
+        with self.lock:
+            # Changes outside of a transaction (activity, expiry) get their own.
+            autocommit = self.depth == 0
+            if autocommit:
+                self.db.execute("BEGIN IMMEDIATE")
+
+            table = "players" if kind == "player" else "games"
+            if record is None:
+                self.db.execute(f"DELETE FROM {table} WHERE uuid = ?", (uuid,))
+            else:
+                self.db.execute(f"INSERT OR REPLACE INTO {table} (uuid, record) VALUES (?, ?)",
+                                (uuid, pickle.dumps(record, pickle.HIGHEST_PROTOCOL)))
+            seq = self.db.execute("INSERT INTO changes (kind, uuid) VALUES (?, ?)", (kind, uuid)).lastrowid
+
+            if autocommit:
+                self.db.execute("COMMIT")
+            elif seq == self.last_seq + 1:
+                # We hold the write lock and caught up at the beginning of the transaction : nothing to sync.
+                self.last_seq = seq
+
+    def player_changed(self, player):
+        self._write("player", player.uuid, persistence.dump_player(player))
+
+    def player_removed(self, player):
+        self._write("player", player.uuid, None)
+
+    def game_changed(self, game):
+        self._write("game", game.uuid, persistence.dump_game(game))
+
+    def game_removed(self, game):
+        self._write("game", game.uuid, None)
+
+    ## BACKGROUND THREAD ##
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="storage", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        last_prune = time.time()
+        while self.running:
+            time.sleep(self.sync_interval)
+            try:
+                self.sync()
+                if time.time() - last_prune >= PRUNE_INTERVAL:
+                    with self.lock:
+                        self.db.execute("DELETE FROM changes WHERE seq <= ?", (self.last_seq - CHANGES_KEPT,))
+                    last_prune = time.time()
+            except sqlite3.OperationalError:
+                logger.exception("Couldn't sync with the database, will try again.")
+
+    def close(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+        with self.lock:
+            self.db.close()
+            self.db = None
+        self.cache.journal = None
+        self.cache.storage = None
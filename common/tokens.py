@@ -0,0 +1,70 @@
+#!/usr/bin/env python3.6
+# -*- coding:Utf-8 -*-
+"""
+Signed authentication tokens : "s1.<issue time>.<signature>", the signature being an HMAC of the player uuid and the
+issue time. They can be checked without looking the token up, by any worker or shard knowing the secret.
+"""
+import base64
+import hashlib
+import hmac
+import threading
+
+import time
+
+from collections import OrderedDict
+
+PREFIX = "s1."
+SIGNATURE_SIZE = 18
+VERIFIED_CACHE_SIZE = 10000
+
+
+class TokenSigner:
+    def __init__(self, secret, max_age=None, cache_size=VERIFIED_CACHE_SIZE):
+        self.secret = secret.encode()
+        self.max_age = max_age
+        self.cache_size = cache_size
+
+        self.lock = threading.Lock()
+        # (uuid, token) -> issue time, for tokens whose signature was already checked. Most recently used last.
+        self.verified = OrderedDict()
+
+    def _signature(self, uuid, issued):
+        digest = hmac.new(self.secret, f"{uuid}.{issued:x}".encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:SIGNATURE_SIZE]).decode()
+
+    def sign(self, uuid, issued=None):
+        issued = int(issued or time.time())
+        return f"{PREFIX}{issued:x}.{self._signature(uuid, issued)}"
+
+    @staticmethod
+    def is_signed(token):
+        return token.startswith(PREFIX)
+
+    def verify(self, uuid, token, now=None):
+        """
+        Returns True if the token was signed for this uuid, and isn't older than max_age.
+        """
+        key = (uuid, token)
+        with self.lock:
+            issued = self.verified.get(key)
+            if issued is not None:
+                self.verified.move_to_end(key)
+
+        if issued is None:
+            try:
+                issued_hex, signature = token[len(PREFIX):].split(".", 1)
+                issued = int(issued_hex, 16)
+            except ValueError:
+                return False
+            # As bytes : compare_digest refuses str with non-ASCII characters
+            if not hmac.compare_digest(signature.encode(), self._signature(uuid, issued).encode()):
+                return False
+
+            with self.lock:
+                self.verified[key] = issued
+                if len(self.verified) > self.cache_size:
+                    self.verified.popitem(last=False)
+
+        if self.max_age and (now or time.time()) - issued > self.max_age:
+            return False
+        return True
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3.6
+# -*- coding:Utf-8 -*-
+"""
+Cache of the serialized views of the games and players (the JSON sent to the clients), so that a view polled by many
+clients is only built and encoded once per version of the object.
+
+When a view is missing and many requests ask for it at the same time, only one of them builds it, and the others wait
+for its result (single-flight).
+"""
+import threading
+
+from collections import OrderedDict
+
+VIEW_CACHE_SIZE = 10000
+
+
+class _Flight:
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ViewCache:
+    def __init__(self, size=VIEW_CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        # Key -> (version, serialized view). Least recently used first.
+        self.views = OrderedDict()
+        # (key, version) -> _Flight, for the views being built
+        self.flights = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, build):
+        """
+        Return the serialized view `key`, as of `version` of the object. If it isn't cached, it is made by calling
+        `build()`, that must return (version, bytes) : the version the object had when the view was built, read at the
+        same time as the view (the object may have changed since `version` was read). The view is cached under it.
+        Views of another version are stale : they are replaced.
+        """
+        with self.lock:
+            cached = self.views.get(key)
+            if cached and cached[0] == version:
+                self.views.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+
+            self.misses += 1
+            flight = self.flights.get((key, version))
+            leader = flight is None
+            if leader:
+                flight = self.flights[(key, version)] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.value
+
+        built_version = version
+        try:
+            built_version, flight.value = build()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[(key, version)]
+                if flight.error is None:
+                    self.views[key] = (built_version, flight.value)
+                    self.views.move_to_end(key)
+                    if len(self.views) > self.size:
+                        self.views.popitem(last=False)
+            flight.done.set()
+
+        return flight.value
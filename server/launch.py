@@ -2,16 +2,65 @@
 # -*- coding:Utf-8 -*-
 
 
+import atexit
+import json
 import logging
+import os
+import queue
+import random
 
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 import hug
 import time
 import common.objects as obj
 import common.cache as cache
+import common.persistence as persistence
+import common.storage as storage
+import common.sharding as sharding
+import common.metrics as metrics
+import common.tokens as tokens
+import common.scheduler as scheduler
+import common.archive as archive
+import common.views as views
+import common.events as events
 
 cache_store = cache.Cache()
+server_metrics = metrics.Metrics()
+view_cache = views.ViewCache()
+
+# When running behind server/router.py : "index/count" of this shard, and the secret shared with the router.
+SHARD = os.environ.get("WEREWOLVES_SHARD", "")
+SHARD_SECRET = os.environ.get("WEREWOLVES_SHARD_SECRET", "")
+SHARD_INDEX, SHARD_COUNT = sharding.parse_shard(SHARD) if SHARD else (0, 1)
+# Where the players and games are saved, to survive restarts. Set to an empty string to disable persistence.
+# Each shard has its own directory, as a directory can only be used by one process.
+DATA_DIR = os.environ.get("WEREWOLVES_DATA_DIR", os.path.join("data", f"shard-{SHARD_INDEX}") if SHARD else "data")
+# SQLite database shared by all the workers. Needed to run more than one worker, replaces DATA_DIR.
+SQLITE_PATH = os.environ.get("WEREWOLVES_SQLITE", "")
+# Summaries of the finished games. Set to an empty string to forget finished games once archived.
+ARCHIVE_PATH = os.environ.get("WEREWOLVES_ARCHIVE", os.path.join(DATA_DIR, "archive.jsonl") if DATA_DIR else "")
+# Event logs of the games, a file per game (see common/events.py). Set to an empty string to disable them.
+EVENTS_PATH = os.environ.get("WEREWOLVES_EVENTS", os.path.join(DATA_DIR, "events") if DATA_DIR else "")
+# When set, login gives signed tokens, checked without looking them up. Must be the same for all workers and shards.
+TOKEN_SECRET = os.environ.get("WEREWOLVES_TOKEN_SECRET", "")
+# Signed tokens older than that (in seconds) are refused. 0 for no limit.
+TOKEN_MAX_AGE = int(os.environ.get("WEREWOLVES_TOKEN_MAX_AGE", "0"))
+
+LONG_POLL_MAX = 30
+BULK_MAX = 500
+HISTORY_PAGE_MAX = 100
+
+LOG_LEVEL = os.environ.get("WEREWOLVES_LOG_LEVEL", "INFO")
+LOG_FILE_SIZE = 50 * 1024 * 1024
+LOG_FILE_COUNT = 5
+# Part of the requests that are logged, by route. Polling routes are very frequent and not very interesting.
+LOG_SAMPLING = {
+    "/v1/game_status": 0.01,
+    "/v1/player_status": 0.01,
+    "/v1/players_status": 0.01,
+    "/v1/status": 0.01,
+}
 
 
 ## LOGGER ##
@@ -129,37 +178,191 @@ if platform.system() == 'Windows':
 else:
     ColorStreamHandler = _AnsiColorStreamHandler
 
+class _JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, with the fields given in `extra` (route, status, duration...)
+    """
+    FIELDS = ("route", "status", "duration_ms", "player")
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "where": f"{record.filename}:{record.lineno}",
+            "message": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                data[field] = getattr(record, field)
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class _SamplingFilter(logging.Filter):
+    """
+    Only keep a part of the records about a route, according to LOG_SAMPLING. Warnings and errors are always kept.
+    """
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not hasattr(record, "route"):
+            return True
+        return random.random() < LOG_SAMPLING.get(record.route, 1)
+
+
+class _BackgroundQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # The arguments may be changed once the record is queued (eg. the players of a game) : the message is made now,
+        # and only the formatting of the line is left to the listener thread. Records of the disabled levels never get
+        # here, so their message is never made.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
 logger = logging.getLogger("werewolves")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 formatter = logging.Formatter(
     '%(asctime)s :: %(levelname)s :: [%(filename)s:%(lineno)s - %(funcName)20s() ] %(message)s')
-file_handler = RotatingFileHandler('werewolves.log', 'a', 10000, 1)
-file_handler.setLevel(logging.DEBUG)
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+file_handler = RotatingFileHandler('werewolves.log', 'a', LOG_FILE_SIZE, LOG_FILE_COUNT)
+file_handler.setFormatter(_JsonFormatter())
 
 steam_handler = ColorStreamHandler()
-steam_handler.setLevel(logging.DEBUG)
-# steam_handler.setLevel(logging.INFO)
-
 steam_handler.setFormatter(formatter)
-logger.addHandler(steam_handler)
+
+# Handlers are run by a background thread, requests only put the records in a queue.
+log_queue = queue.Queue()
+queue_handler = _BackgroundQueueHandler(log_queue)
+queue_handler.addFilter(_SamplingFilter())
+logger.addHandler(queue_handler)
+log_listener = QueueListener(log_queue, file_handler, steam_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 logger.debug("Starting... :)")
 
+# Created before loading the games, so they are scheduled
+phase_scheduler = scheduler.PhaseScheduler(cache_store)
+
+if SQLITE_PATH:
+    shared_storage = storage.SQLiteStorage(cache_store, SQLITE_PATH)
+    shared_storage.open()
+    shared_storage.start()
+elif DATA_DIR:
+    journal = persistence.Journal(cache_store, DATA_DIR)
+    journal.open()
+    journal.start()
+
+if ARCHIVE_PATH:
+    cache_store.archive = archive.Archive(ARCHIVE_PATH)
+    cache_store.archive.open()
+
+if EVENTS_PATH:
+    cache_store.event_log = events.EventStore(EVENTS_PATH)
+    cache_store.event_log.open()
+
+phase_scheduler.start()
+
+token_signer = tokens.TokenSigner(TOKEN_SECRET, TOKEN_MAX_AGE) if TOKEN_SECRET else None
+
 
 ## WEREWOLVES ##
 
 def gen_error(name, message):
+    server_metrics.record_error(name)
     return {"errors": {name: message}}
 
 
+def not_modified(request, response, etag):
+    """
+    Set the ETag of the response, and turn it into a 304 Not Modified if the client already has this version.
+
+    Returns True if the response body should be skipped.
+    """
+    response.set_header("ETag", etag)
+    if request.get_header("If-None-Match") == etag:
+        response.status = hug.HTTP_304
+        return True
+    return False
+
+
+@hug.format.content_type("application/json; charset=utf-8")
+def json_views(content, request=None, response=None):
+    """
+    JSON output format, letting the views serialized by view_cache through as they are.
+    """
+    if isinstance(content, bytes):
+        return content
+    return hug.output_format.json(content, request, response)
+
+
+def serialize(content):
+    return hug.output_format.json(content)
+
+
+def with_time_left(view, game):
+    # time_left changes every second, it is added to the cached view of the game
+    return view[:-1] + b', "time_left": ' + str(int(game.need_to_complete_phase_before - time.time())).encode() + b"}"
+
+
+def game_view(game, since=None, expand=None):
+    """
+    Serialized game_status response. See game_status.
+    """
+    def build():
+        with cache_store.reading():
+            version = game.etag(with_players=(expand == "players"))
+            res = None
+            if since is not None:
+                res = game.changes_since(since)
+            if not res:
+                res = game.public_dict()
+
+            res.pop("time_left", None)
+
+            if expand == "players":
+                if res.get("delta"):
+                    uuids = res["added"].get("players", [])
+                else:
+                    uuids = res["players"]
+                res["players_profiles"] = {u: p.public_dict() for u, p in get_players(uuids).items()}
+        return version, serialize(res)
+
+    view = view_cache.get(("game", game.uuid, since, expand), game.etag(with_players=(expand == "players")), build)
+    return with_time_left(view, game)
+
+
+def player_view(player, private=False, games_offset=0, games_limit=obj.HISTORY_PAGE):
+    def build():
+        with cache_store.reading():
+            version = player.revision
+            if private:
+                res = player.private_dict(games_offset, games_limit)
+            else:
+                res = player.public_dict(games_offset, games_limit)
+        return version, serialize(res)
+
+    return view_cache.get(("player", player.uuid, private, games_offset, games_limit), player.revision, build)
+
+
+def new_uuid():
+    # Players and games created here must be routed here.
+    return sharding.owned_uuid(SHARD_INDEX, SHARD_COUNT)
+
+
 def check_auth(uuid, token):
-    player = cache_store.get_user_from_auth(uuid, token)
+    if token_signer and token_signer.is_signed(token):
+        # The signature proves who the player is, but the endpoints need the player itself, and a signed token of a
+        # player that expired or doesn't live on this shard must be refused : it is still looked up, by uuid.
+        player = cache_store.get_player_by_uuid(uuid) if token_signer.verify(uuid, token) else None
+    else:
+        player = cache_store.get_user_from_auth(uuid, token)
+
     if player:
-        player.last_activity = int(time.time())
-        logger.debug(f"Auth for user {uuid} with {token} returned {player.display_name}")
+        cache_store.touch_player(player)
+        logger.debug("Auth for user %s returned %s", uuid, player.display_name)
     else:
-        logger.warning(f"Auth for user {uuid} with {token} failed with {player}")
+        logger.warning("Auth for user %s failed", uuid)
     return player
 
 
@@ -168,12 +371,21 @@ uuid_token_authentication = hug.authentication.basic(check_auth)
 
 @hug.request_middleware()
 def process_data(request, response):
-    logger.debug(f"-> {request.url} || {request.params}")
+    cache_store.sync()
+    request.context["time_start"] = time.time()
+    route = request.context["route"] = server_metrics.route(request.path)
+    server_metrics.start_request(route)
+    logger.debug("-> %s || %s", request.url, request.params, extra={"route": route})
 
 @hug.response_middleware()
 def process_data(request, response, resource):
-    logger.debug(f"<- {request.url} || ({response.status}) {response.body} ")
-    logger.info(f"<-> {request.url}")
+    duration = time.time() - request.context.get("time_start", time.time())
+    duration_ms = round(duration * 1000, 1)
+    route = request.context.get("route") or server_metrics.route(request.path)
+    server_metrics.record_request(route, response.status.split(" ", 1)[0], duration)
+    extra = {"route": route, "status": response.status, "duration_ms": duration_ms}
+    logger.debug("<- %s || (%s) %s", request.url, response.status, response.body, extra=extra)
+    logger.info("<-> %s (%s) in %s ms", request.url, response.status, duration_ms, extra=extra)
 
 @hug.post('/login', versions=1)
 def login(name: hug.types.text):
@@ -182,15 +394,40 @@ def login(name: hug.types.text):
 
     Returns a public player profile, with a non-public token, that will only be sent once.
     """
-    player = obj.Player(name)
-    cache_store.players.add(player)
-    res = player.public_dict()
-    res["token"] = player.token
-    logger.info(f"User {player.display_name} logged in.")
+    with cache_store.transaction():
+        player = obj.Player(name, new_uuid())
+        if token_signer:
+            player.token = token_signer.sign(player.uuid)
+        cache_store.add_player(player)
+        res = player.public_dict()
+        res["token"] = player.token
+        logger.info("User %s logged in.", player.display_name)
 
     return res
 
 
+@hug.post('/register_player', versions=1)
+def register_player(request, response, uuid: hug.types.text, token: hug.types.text, name: hug.types.text):
+    """
+    Internal, used by the router when sharding : make a player created on another shard known here.
+    The router must send the shard secret in the X-Shard-Secret header.
+
+    Possible errors are :
+        - NotAllowed : Sharding isn't enabled, or the secret is wrong
+    """
+    if not SHARD_SECRET or request.get_header("X-Shard-Secret") != SHARD_SECRET:
+        # Not a 200, so the router doesn't take it for a registered player
+        response.status = hug.HTTP_403
+        return gen_error("NotAllowed", "You are not allowed to register players")
+
+    with cache_store.transaction():
+        if not cache_store.get_player_by_uuid(uuid):
+            player = obj.Player(name, uuid)
+            player.token = token
+            cache_store.add_player(player)
+            logger.info("User %s registered from another shard.", player.display_name)
+
+
 @hug.post('/create_game', versions=1, requires=uuid_token_authentication)
 def create_game(player: hug.directives.user, name: hug.types.text):
     """
@@ -198,16 +435,16 @@ def create_game(player: hug.directives.user, name: hug.types.text):
 
     Returns a Game dict
     """
-    game = obj.Game(name, player)
-    cache_store.games.add(game)
+    with cache_store.transaction():
+        game = obj.Game(name, player, new_uuid())
+        cache_store.add_game(game)
 
-    game.players.add(player)
-    player.games.add(game)
-    player.current_game = game
+        player.games_created.add(game)
+        game.join(player)
 
-    logger.info(f"User {player.display_name} created game {game.display_name}")
+        logger.info("User %s created game %s", player.display_name, game.display_name)
 
-    res = game.uuid
+        res = game.uuid
 
     return res
 
@@ -224,17 +461,16 @@ def join_game(player: hug.directives.user, uuid: hug.types.text):
         - GameNotFound : The game specified couldn't be found
 
     """
-    game = cache_store.get_game_by_uuid(uuid)
-    if game:
-        if game.phase == 0:
-            game.players.add(player)
-            player.games.add(game)
-            player.current_game = game
-            logger.info(f"User {player.display_name} joined game {game.display_name}")
+    with cache_store.transaction():
+        game = cache_store.get_game_by_uuid(uuid)
+        if game:
+            if game.phase == 0:
+                game.join(player)
+                logger.info("User %s joined game %s", player.display_name, game.display_name)
+            else:
+                return gen_error("GameNotJoinable", "The selected game started and couldn't be joined.")
         else:
-            return gen_error("GameNotJoinable", "The selected game started and couldn't be joined.")
-    else:
-        return gen_error("GameNotFound", "The selected game couldn't be found.")
+            return gen_error("GameNotFound", "The selected game couldn't be found.")
 
 
 @hug.post('/leave_game', versions=1, requires=uuid_token_authentication)
@@ -249,24 +485,46 @@ def leave_game(player: hug.directives.user, uuid: hug.types.text):
         - NotInGame : You are not in this game
 
     """
-    game = cache_store.get_game_by_uuid(uuid)
-    if game:
-        if player in game.players:
-            game.players.remove(player)
-            player.current_game = None
-            logger.info(f"User {player.display_name} left game {game.display_name}")
-        else:
-            return gen_error("NotInGame", "You can't leave a game you didn't joined.")
+    with cache_store.transaction():
+        game = cache_store.get_game_by_uuid(uuid)
+        if game:
+            if player in game.players:
+                game.leave(player)
+                logger.info("User %s left game %s", player.display_name, game.display_name)
+                if len(game.players) == 0:
+                    cache_store.remove_game(game)
+            else:
+                return gen_error("NotInGame", "You can't leave a game you didn't joined.")
 
-    else:
-        return gen_error("GameNotFound", "The selected game couldn't be found.")
+        else:
+            return gen_error("GameNotFound", "The selected game couldn't be found.")
 
 
-@hug.post('/game_status', versions=1, requires=uuid_token_authentication)
-def game_status(player: hug.directives.user, uuid: hug.types.text):
+@hug.post('/game_status', versions=1, requires=uuid_token_authentication, output=json_views)
+def game_status(request, response, player: hug.directives.user, uuid: hug.types.text,
+                revision: hug.types.number = None, wait: hug.types.number = 0, since: hug.types.number = None,
+                expand: hug.types.text = None):
     """
     Get the latest information about a game. Must be called frequently by clients to update users lists, phases...
 
+    Long polling : if `revision` is the revision the client already knows and `wait` is given, the call blocks until
+    the game changes (including moving to the next phase) or `wait` seconds (at most LONG_POLL_MAX) elapsed.
+    Long polling requires a threaded server (eg. gunicorn with --threads), as it holds a worker while waiting.
+
+    The response has an ETag. If it is sent back in If-None-Match and the game didn't change, the server replies with
+    an empty 304 Not Modified.
+
+    Delta mode : if `since` is a revision the client has, only what changed since then is returned, as a dict with
+    "delta": True, the roster members "added" and "removed" for each players list, the new values of the other
+    changed fields in "set", and time_left. If the server doesn't remember that revision anymore, a full Game dict is
+    returned.
+
+    With expand=players, the public profiles of the players (only the added ones for a delta) are inlined in
+    "players_profiles", as a dict indexed by uuid.
+
+    Finished games are archived after a while. For an archived game, its summary is returned instead, with
+    "archived": True, the fields of a Game dict that still make sense, and the role of each player in "roles".
+
     Returns a Game dict
 
     Possible errors are :
@@ -274,37 +532,79 @@ def game_status(player: hug.directives.user, uuid: hug.types.text):
     """
     game = cache_store.get_game_by_uuid(uuid)
     if game:
-        game.tick()
-        res = game.public_dict()
-        return res
+        if revision is not None and wait > 0 and game.revision == revision:
+            game.wait_for_change(revision, min(wait, LONG_POLL_MAX))
+        if not_modified(request, response, game.etag(with_players=(expand == "players"))):
+            return
+        return game_view(game, since, expand)
     else:
+        summary = cache_store.get_archived_game(uuid)
+        if summary:
+            summary["archived"] = True
+            return summary
         return gen_error("GameNotFound", "The selected game couldn't be found.")
 
 
-@hug.post('/player_status', versions=1, requires=uuid_token_authentication)
-def player_status(player: hug.directives.user, uuid: hug.types.text):
+@hug.post('/player_status', versions=1, requires=uuid_token_authentication, output=json_views)
+def player_status(request, response, player: hug.directives.user, uuid: hug.types.text,
+                  games_offset: hug.types.number = 0, games_limit: hug.types.number = obj.HISTORY_PAGE):
     """
     Get the latest information about a player.
     Must be called by clients to update cards, current_games, status and more...
 
+    Only a page of the games played is returned, most recent first : use games_offset and games_limit (at most
+    HISTORY_PAGE_MAX) to get the others. games_count is the total number of games played.
+
+    Like game_status, the response has an ETag and a 304 Not Modified is returned if it matches If-None-Match.
+
     Returns a Game dict
 
     Possible errors are :
         - PlayerNotFound : The game specified couldn't be found
     """
     player_selected = cache_store.get_player_by_uuid(uuid)
+    games_limit = max(0, min(games_limit, HISTORY_PAGE_MAX))
+    page = f"{games_offset}-{games_limit}"
 
     if player == player_selected:
-        res = player_selected.private_dict()
-        logger.debug(str(res))
-        return res
-    elif player:
-        res = player_selected.public_dict()
-        return res
+        if not_modified(request, response, player_selected.etag(private=True, page=page)):
+            return
+        return player_view(player_selected, True, games_offset, games_limit)
+    elif player_selected:
+        if not_modified(request, response, player_selected.etag(page=page)):
+            return
+        return player_view(player_selected, False, games_offset, games_limit)
     else:
         return gen_error("PlayerNotFound", "The selected player couldn't be found.")
 
 
+def get_players(uuids):
+    players = {}
+    for uuid in uuids:
+        player = cache_store.get_player_by_uuid(uuid)
+        if player:
+            players[uuid] = player
+    return players
+
+
+@hug.post('/players_status', versions=1, requires=uuid_token_authentication, output=json_views)
+def players_status(player: hug.directives.user, uuids: hug.types.comma_separated_list):
+    """
+    Get the public profiles of many players at once (at most BULK_MAX).
+
+    Returns a dict of public player profiles, indexed by uuid. Players that couldn't be found are left out.
+
+    Possible errors are :
+        - TooManyPlayers : More than BULK_MAX players were requested
+    """
+    if len(uuids) > BULK_MAX:
+        return gen_error("TooManyPlayers", f"You can't request more than {BULK_MAX} players at once.")
+
+    # Made of the cached views of the players
+    profiles = [serialize(uuid) + b": " + player_view(p) for uuid, p in get_players(uuids).items()]
+    return b"{" + b", ".join(profiles) + b"}"
+
+
 @hug.post('/start_game', versions=1, requires=uuid_token_authentication)
 def start_game(player: hug.directives.user, uuid: hug.types.text):
     """
@@ -315,18 +615,19 @@ def start_game(player: hug.directives.user, uuid: hug.types.text):
         - GameCantStart : The game couldn't be started. Maybe there isn't enough players.
         - NotAllowed : You are'nt the game owner, and you can't start it.
     """
-    game = cache_store.get_game_by_uuid(uuid)
-    if game:
-
-        if game.owner == player:
-            started = game.start()
-            if not started:
-                return gen_error("GameCantStart", "Game couldn't be started")
+    with cache_store.transaction():
+        game = cache_store.get_game_by_uuid(uuid)
+        if game:
+
+            if game.owner == player:
+                started = game.start()
+                if not started:
+                    return gen_error("GameCantStart", "Game couldn't be started")
+            else:
+                return gen_error("NotAllowed", "You are not allowed to start the game")
+            logger.info("User %s started game %s", player.display_name, game.display_name)
         else:
-            return gen_error("NotAllowed", "You are not allowed to start the game")
-        logger.info(f"User {player.display_name} started game {game.display_name}")
-    else:
-        return gen_error("GameNotFound", "The selected game couldn't be found.")
+            return gen_error("GameNotFound", "The selected game couldn't be found.")
 
 
 @hug.post('/select_player', versions=1, requires=uuid_token_authentication)
@@ -334,15 +635,16 @@ def select_player(player: hug.directives.user, game_uuid: hug.types.text, player
     """
     Select a player/some players. This function is used to vote on people, select lovers, people to swap card with...
     """
-    game = cache_store.get_game_by_uuid(game_uuid)
+    with cache_store.transaction():
+        game = cache_store.get_game_by_uuid(game_uuid)
 
-    players_uuid = set(players_uuid)
+        players_uuid = set(players_uuid)
 
-    for uuid in players_uuid:
-        if uuid not in [p.uuid for p in game.players_alive]:
-            return gen_error("PlayerNotAlive", f"Player {uuid} is not alive.")
+        for uuid in players_uuid:
+            if uuid not in game.alive_by_uuid:
+                return gen_error("PlayerNotAlive", f"Player {uuid} is not alive.")
 
-    game.votes[player] = players_uuid
+        game.vote(player, players_uuid)
 
 
 @hug.post('/sorceress_select', versions=1, requires=uuid_token_authentication)
@@ -353,55 +655,131 @@ def sorceress_select(player: hug.directives.user, game_uuid: hug.types.text, pla
 
     save_or_kill -> True to save; False to kill.
     """
-    game = cache_store.get_game_by_uuid(game_uuid)
-    target_player = cache_store.get_player_by_uuid(player_uuid)
+    with cache_store.transaction():
+        game = cache_store.get_game_by_uuid(game_uuid)
+        target_player = cache_store.get_player_by_uuid(player_uuid)
 
-    kill = not save_or_kill
-    save = save_or_kill
+        kill = not save_or_kill
+        save = save_or_kill
 
-    if target_player not in game.players_alive and kill:
-        return gen_error("PlayerNotAlive", f"Player {target_player.display_name} is not alive.")
+        if target_player not in game.players_alive and kill:
+            return gen_error("PlayerNotAlive", f"Player {target_player.display_name} is not alive.")
 
-    if target_player not in game.players_killed_last_night and save:
-        return gen_error("PlayerAlive",
-                         f"Player {target_player.display_name} is alive and can't be saved, or was killed for too long.")
+        if target_player not in game.players_killed_last_night and save:
+            return gen_error("PlayerAlive",
+                             f"Player {target_player.display_name} is alive and can't be saved, or was killed for too long.")
 
-    else:
-        if save:
-            if player.cards[game].heal_potion:
-                player.cards[game].heal_potion = False
-            else:
-                gen_error("NoHealPotion", "You don't have a heal potion")
-            game.players_killed_last_night.remove(target_player)
-            game.players_alive.add(target_player)
+        else:
+            if save:
+                if not game.use_potion(player, "heal"):
+                    gen_error("NoHealPotion", "You don't have a heal potion")
+                game.revive(target_player)
 
 
-        else:
-            if player.cards[game].kill_potion:
-                player.cards[game].kill_potion = False
             else:
-                gen_error("NoKillPotion", "You don't have a kill potion")
+                if not game.use_potion(player, "kill"):
+                    gen_error("NoKillPotion", "You don't have a kill potion")
 
-            game.players_killed_last_night.add(target_player)
-            game.players_alive.remove(target_player)
+                game.kill(target_player, last_night=True)
+
+        game.touch()
 
 
 @hug.post('/list_games', versions=1, requires=uuid_token_authentication)
-def list_games():
+def list_games(phase: hug.types.comma_separated_list = None, prefix: hug.types.text = None,
+               order: hug.types.one_of(("newest", "oldest")) = "newest", cursor: hug.types.text = None,
+               limit: hug.types.number = cache.LIST_GAMES_PAGE, summary: hug.types.boolean = True):
     """
-    Return the list of games on the server
+    Return a page of the games on the server, sorted by creation time (newest first, or oldest with order=oldest).
+
+    Filters :
+        - phase : comma separated phases, eg. phase=0 for the games that can be joined
+        - prefix : only the games whose name starts with it (case insensitive)
+
+    Returns a dict with the games in "games", and in "cursor" the value to send back as `cursor` to get the next page
+    (None on the last page). At most `limit` games (cache.LIST_GAMES_MAX) are returned per page. Each game is a dict with its
+    uuid, created_at, revision, and unless summary=false, its name, phase, player_count, owner and owner_name.
+
+    Possible errors are :
+        - InvalidPhase : A phase isn't a number
+        - InvalidCursor : The cursor wasn't returned by list_games
     """
+    try:
+        phases = [int(p) for p in phase] if phase else None
+    except ValueError:
+        return gen_error("InvalidPhase", "Phases must be numbers.")
+
+    if cursor:
+        try:
+            created_at, uuid = cursor.split(".", 1)
+            cursor = (int(created_at), uuid)
+        except ValueError:
+            return gen_error("InvalidCursor", "This cursor is invalid.")
+
+    limit = max(1, min(limit, cache.LIST_GAMES_MAX))
+    with cache_store.reading():
+        games, next_cursor = cache_store.list_games(phases, prefix, cursor or None, limit, order == "newest")
+
+        rows = []
+        for game in games:
+            row = {"uuid": game.uuid, "created_at": game.created_at, "revision": game.revision}
+            if summary:
+                row.update({
+                    "name": game.name,
+                    "phase": game.phase,
+                    "player_count": len(game.players),
+                    "owner": game.owner.uuid,
+                    "owner_name": game.owner.name,
+                })
+            rows.append(row)
 
-    return [g.uuid for g in cache_store.games]
+    return {
+        "games": rows,
+        "cursor": f"{next_cursor[0]}.{next_cursor[1]}" if next_cursor else None,
+    }
 
 
 @hug.get('/status', versions=1)
 @hug.post('/status', versions=1)
-def status():
+def status(details: hug.types.boolean = False):
     """
     Return a status report of the server
+
+    With details=true, the report also has, for each route, the number of requests by HTTP status, the number of
+    each error returned, and the 50th, 95th and 99th percentiles of the latency in ms.
     """
-    return {
+    res = {
         "players_count": len(cache_store.players),
-        "games_count": len(cache_store.games)
+        "games_count": len(cache_store.games),
+    }
+    res.update(gauges())
+    if details:
+        res["routes"] = server_metrics.summary()
+    return res
+
+
+def gauges():
+    return {
+        "games_by_phase": {str(phase): len(games) for phase, games in list(cache_store.games_by_phase.items())},
+        "active_players": cache_store.count_active_players(),
+        "view_cache_hits": view_cache.hits,
+        "view_cache_misses": view_cache.misses,
     }
+
+
+@hug.get('/metrics', versions=1, output=hug.output_format.text)
+def metrics_text():
+    """
+    The request counters, error counters, latency histograms and gauges, in the Prometheus text format.
+    """
+    return server_metrics.text(gauges())
+
+
+# The paths of the endpoints, the metrics of requests to other paths are counted together
+server_metrics.routes = {
+    f"{base_url}/v{version}{url}" if version is not None else f"{base_url}{url}"
+    for base_url, urls in hug.API(__name__).http.routes.items()
+    for url, methods in urls.items()
+    for versions in methods.values()
+    for version in versions
+}
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3.6
+# -*- coding:Utf-8 -*-
+"""
+Router for the sharded mode : forwards every API call to the server process (shard) owning the game or the player,
+so each shard only holds its slice of the games in memory.
+
+    - Calls about one game are sent to the shard owning the game uuid.
+    - Player-scoped calls are sent to the shard owning the player uuid (its "home" shard).
+    - list_games and status are sent to every shard, and the results merged. So are player_status and
+      players_status, as the games of a player may be spread over many shards.
+
+A player is created on its home shard. The first time they call another shard, that shard doesn't know them and
+answers 401 : the router then checks the credentials against the home shard, registers the player on the other shard
+(register_player) and retries.
+
+Launch the shards with WEREWOLVES_SHARD=<index>/<count> and the same WEREWOLVES_SHARD_SECRET, then the router with
+WEREWOLVES_SHARDS set to the comma separated shard urls, in the same order, and WEREWOLVES_SHARD_SECRET :
+
+    WEREWOLVES_SHARDS=http://127.0.0.1:8001,http://127.0.0.1:8002 gunicorn3 router:app --threads 32
+"""
+import base64
+import http.client
+import itertools
+import json
+import logging
+import os
+import threading
+import urllib.parse
+
+from common import cache, sharding
+
+logger = logging.getLogger("werewolves")
+
+SHARDS = [s for s in os.environ.get("WEREWOLVES_SHARDS", "").split(",") if s]
+SHARD_SECRET = os.environ.get("WEREWOLVES_SHARD_SECRET", "")
+TIMEOUT = 60
+
+# Endpoint -> parameter with the uuid of the game the call is about
+GAME_ROUTES = {
+    "join_game": "uuid",
+    "leave_game": "uuid",
+    "start_game": "uuid",
+    "game_status": "uuid",
+    "select_player": "game_uuid",
+    "sorceress_select": "game_uuid",
+}
+FAN_OUT = {"list_games", "status", "player_status", "players_status"}
+
+
+class Router:
+    def __init__(self, shards, secret):
+        self.shards = [urllib.parse.urlsplit(s) for s in shards]
+        self.secret = secret
+        self.local = threading.local()
+        self.next_shard = itertools.count()
+
+    ## FORWARDING ##
+
+    def _connection(self, index):
+        connections = self.local.__dict__.setdefault("connections", {})
+        if index not in connections:
+            shard = self.shards[index]
+            connections[index] = http.client.HTTPConnection(shard.hostname, shard.port, timeout=TIMEOUT)
+        return connections[index]
+
+    def forward(self, index, method, path, body, headers):
+        """
+        Send a request to a shard, on a kept-alive connection. Returns (status, headers, body).
+        """
+        for attempt in range(2):
+            connection = self._connection(index)
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                return response.status, response.getheaders(), response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                del self.local.connections[index]
+                if attempt:
+                    raise
+
+    def home_shard(self, player_uuid):
+        return sharding.shard_of(player_uuid, len(self.shards))
+
+    def register(self, index, player_uuid, headers):
+        """
+        Make the player known by the shard `index`, if their credentials are valid on their home shard.
+        """
+        home = self.home_shard(player_uuid)
+        body = urllib.parse.urlencode({"uuid": player_uuid})
+        status_headers = {"Content-Type": "application/x-www-form-urlencoded", "Authorization": headers["Authorization"]}
+        status, _, data = self.forward(home, "POST", "/v1/player_status", body, status_headers)
+        if status != 200:
+            return False
+
+        profile = json.loads(data)
+        token = base64.b64decode(headers["Authorization"].split(" ", 1)[1]).decode().split(":", 1)[1]
+        body = urllib.parse.urlencode({"uuid": player_uuid, "token": token, "name": profile["name"]})
+        register_headers = {"Content-Type": "application/x-www-form-urlencoded", "X-Shard-Secret": self.secret}
+        status, _, data = self.forward(index, "POST", "/v1/register_player", body, register_headers)
+        result = json.loads(data) if data else None
+        if status != 200 or (isinstance(result, dict) and "errors" in result):
+            logger.warning("Couldn't register player %s on shard %s : %s %s", player_uuid, index, status, data)
+            return False
+        return True
+
+    def call(self, index, method, path, body, headers, player_uuid):
+        status, response_headers, data = self.forward(index, method, path, body, headers)
+        if status == 401 and player_uuid and index != self.home_shard(player_uuid):
+            if self.register(index, player_uuid, headers):
+                status, response_headers, data = self.forward(index, method, path, body, headers)
+        return status, response_headers, data
+
+    ## MERGING ##
+
+    @classmethod
+    def merge_status(cls, status, other):
+        for key, value in other.items():
+            if isinstance(value, dict):
+                cls.merge_status(status.setdefault(key, {}), value)
+            elif key.endswith("_ms"):
+                # Percentiles can't be added up, keep the worst shard
+                status[key] = max(status.get(key, 0), value)
+            else:
+                status[key] = status.get(key, 0) + value
+        return status
+
+    @staticmethod
+    def merge_profiles(profile, other):
+        for key in ("games", "games_created"):
+            profile[key] = profile[key] + [g for g in other[key] if g not in profile[key]]
+        # Each shard has its own revisions of the player : their sum goes up whenever one of them does
+        for key in ("games_count", "games_created_count", "revision"):
+            profile[key] = profile.get(key, 0) + other.get(key, 0)
+        if "cards" in other:
+            profile.setdefault("cards", {}).update(other["cards"])
+            profile["current_game"] = profile.get("current_game") or other["current_game"]
+            profile["love"] = profile.get("love") or other["love"]
+        return profile
+
+    def merge(self, endpoint, results, params):
+        if endpoint == "list_games":
+            # Every shard sent its page from the same cursor : keep the best of them
+            newest_first = params.get("order", "newest") == "newest"
+            limit = max(1, min(int(params.get("limit", cache.LIST_GAMES_PAGE)), cache.LIST_GAMES_MAX))
+            games = sorted((game for result in results for game in result["games"]),
+                           key=lambda g: (g["created_at"], g["uuid"]), reverse=newest_first)
+            more = len(games) > limit or any(r["cursor"] for r in results)
+            games = games[:limit]
+            cursor = f"{games[-1]['created_at']}.{games[-1]['uuid']}" if games and more else None
+            return {"games": games, "cursor": cursor}
+
+        if endpoint == "status":
+            # Players are counted once per shard they used
+            merged = {}
+            for result in results:
+                self.merge_status(merged, result)
+            return merged
+
+        if endpoint == "player_status":
+            profiles = [r for r in results if "errors" not in r]
+            if not profiles:
+                return results[0]
+            merged = profiles[0]
+            for profile in profiles[1:]:
+                self.merge_profiles(merged, profile)
+            return merged
+
+        if endpoint == "players_status":
+            merged = {}
+            for result in results:
+                if "errors" in result:
+                    return result
+                for uuid, profile in result.items():
+                    merged[uuid] = self.merge_profiles(merged[uuid], profile) if uuid in merged else profile
+            return merged
+
+    ## WSGI ##
+
+    def __call__(self, environ, start_response):
+        method = environ["REQUEST_METHOD"]
+        path = environ.get("PATH_INFO", "/")
+        query = environ.get("QUERY_STRING", "")
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = environ["wsgi.input"].read(length) if length else b""
+
+        params = dict(urllib.parse.parse_qsl(query))
+        if environ.get("CONTENT_TYPE", "").startswith("application/x-www-form-urlencoded"):
+            params.update(urllib.parse.parse_qsl(body.decode()))
+
+        headers = {"Content-Type": environ.get("CONTENT_TYPE", "")}
+        for header in ("Authorization", "If-None-Match"):
+            value = environ.get("HTTP_" + header.upper().replace("-", "_"))
+            if value:
+                headers[header] = value
+
+        player_uuid = None
+        if "Authorization" in headers:
+            try:
+                player_uuid = base64.b64decode(headers["Authorization"].split(" ", 1)[1]).decode().split(":", 1)[0]
+            except (ValueError, IndexError):
+                pass
+
+        endpoint = path.rstrip("/").rsplit("/", 1)[-1]
+        full_path = path + ("?" + query if query else "")
+
+        if endpoint == "register_player":
+            status, response_headers, data = 403, [], b'{"errors": {"NotAllowed": "Internal endpoint"}}'
+
+        elif endpoint in FAN_OUT:
+            # Conditional requests don't make sense once merged
+            headers.pop("If-None-Match", None)
+            results = []
+            for index in range(len(self.shards)):
+                status, response_headers, data = self.call(index, method, full_path, body, headers, player_uuid)
+                if status == 200:
+                    results.append(json.loads(data))
+                elif endpoint != "player_status":
+                    break
+            else:
+                status = 200 if results else status
+                if results:
+                    data = json.dumps(self.merge(endpoint, results, params)).encode()
+                response_headers = [("Content-Type", "application/json")]
+
+        else:
+            if endpoint in GAME_ROUTES and params.get(GAME_ROUTES[endpoint]):
+                index = sharding.shard_of(params[GAME_ROUTES[endpoint]], len(self.shards))
+            elif player_uuid:
+                index = self.home_shard(player_uuid)
+            else:
+                # login : any shard will do, the player will be created with an uuid owned by that shard
+                index = next(self.next_shard) % len(self.shards)
+
+            status, response_headers, data = self.call(index, method, full_path, body, headers, player_uuid)
+
+        response_headers = [(k, v) for k, v in response_headers
+                            if k.lower() not in ("connection", "transfer-encoding", "content-length")]
+        response_headers.append(("Content-Length", str(len(data))))
+        start_response(f"{status} {http.client.responses.get(status, '')}", response_headers)
+        return [data]
+
+
+app = Router(SHARDS, SHARD_SECRET)
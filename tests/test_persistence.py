@@ -0,0 +1,92 @@
+#!/usr/bin/env python3.6
+# -*- coding:Utf-8 -*-
+"""
+Restarts of a journaled cache (common.persistence). From the root of the repository :
+
+    python3 -m unittest discover tests
+"""
+import tempfile
+import unittest
+
+import time
+
+from common import cache, objects, persistence
+
+
+class RestartTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache, self.journal = self.open()
+
+    def tearDown(self):
+        self.journal.close()
+        self.tmp.cleanup()
+
+    def open(self):
+        cache_store = cache.Cache()
+        journal = persistence.Journal(cache_store, self.tmp.name)
+        journal.open()
+        return cache_store, journal
+
+    def restart(self):
+        self.journal.close()
+        self.cache, self.journal = self.open()
+
+    def started_game(self, size=5):
+        players = [objects.Player(f"Player {i}") for i in range(size)]
+        with self.cache.transaction():
+            for player in players:
+                self.cache.add_player(player)
+            game = objects.Game("Restart", players[0])
+            self.cache.add_game(game)
+            players[0].games_created.add(game)
+            for player in players:
+                game.join(player)
+            game.start()
+        return game, players
+
+    def test_game_survives_restart(self):
+        game, players = self.started_game()
+        self.restart()
+
+        loaded = self.cache.get_game_by_uuid(game.uuid)
+        self.assertIsNotNone(loaded)
+        self.assertEqual({p.uuid for p in loaded.players}, {p.uuid for p in players})
+        self.assertEqual(loaded.owner.uuid, players[0].uuid)
+        for player in loaded.players:
+            self.assertIn(player.cards[loaded], loaded.cards)
+
+    def test_game_of_expired_owner_survives_restart(self):
+        game, players = self.started_game()
+        owner = players[0]
+        long_ago = time.time() - cache.PLAYER_EXPIRY - 2 * cache.ACTIVITY_BUCKET
+        self.cache.touch_player(owner, now=long_ago)
+        with self.cache.transaction():
+            self.assertEqual(self.cache.expire(), (1, 0))
+
+        self.assertIsNone(self.cache.get_player_by_uuid(owner.uuid))
+        new_owner = self.cache.get_game_by_uuid(game.uuid).owner
+        self.assertIn(new_owner, game.players)
+        self.assertIn(game, self.cache.get_games_by_owner(new_owner))
+
+        self.restart()
+
+        loaded = self.cache.get_game_by_uuid(game.uuid)
+        self.assertIsNotNone(loaded)
+        self.assertEqual(loaded.owner.uuid, new_owner.uuid)
+        self.assertEqual({p.uuid for p in loaded.players}, {p.uuid for p in players[1:]})
+
+    def test_game_record_without_its_owner_is_loaded(self):
+        # Records written before ownership was handed over on expiry
+        game, players = self.started_game()
+        self.journal.player_removed(players[0])
+        self.restart()
+
+        loaded = self.cache.get_game_by_uuid(game.uuid)
+        self.assertIsNotNone(loaded)
+        self.assertEqual(loaded.owner.uuid, min(p.uuid for p in players[1:]))
+        self.assertIn(loaded, self.cache.get_games_by_owner(loaded.owner))
+
+
+if __name__ == '__main__':
+    unittest.main()